@@ -1,2 +1,10 @@
 from __future__ import absolute_import
-from .core import COMMANDS
+
+
+def get_commands():
+    """Returns dict of command name -> function. Modules of commands
+    are imported here, because commands served by the daemon need
+    only the client module."""
+    from .core import COMMANDS
+    from .server import serve
+    return dict(COMMANDS, serve=serve)
@@ -0,0 +1,57 @@
+# coding: utf-8
+"""Thin client of the 'dot serve' daemon.
+
+It is used on each invocation of 'dot' before anything else, so it
+imports only modules needed to talk to the daemon. The rest of the
+package is imported only if the command is not served.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import socket
+
+
+SOCKET_FILENAME = '.dot.sock'
+SERVED_COMMANDS = ('update', 'plan', 'status')
+
+
+def get_socket_path(base_dir):
+    return os.path.join(base_dir, SOCKET_FILENAME)
+
+
+def call_server(command, base_dir, home_dir, args):
+    """Sends a command to the running daemon and reproduces its output.
+    Returns exit code of the command or None if there is no daemon
+    for the base_dir."""
+    socket_path = get_socket_path(base_dir)
+    if not os.path.exists(socket_path):
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # a stale socket of the daemon which is not running anymore
+            return None
+
+        request = dict(command=command, home_dir=home_dir, args=args)
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+        exit_code = 0
+        with client.makefile('rb') as f:
+            for line in f:
+                data = json.loads(line.decode('utf-8'))
+                if data.get('done'):
+                    exit_code = data.get('exit_code', 0)
+                    break
+                if 'stdout' in data:
+                    print(data['stdout'], end='')
+                else:
+                    logging.log(data['level'], data['message'],
+                                extra=dict(color=data['color']))
+    finally:
+        client.close()
+    return exit_code
@@ -0,0 +1,84 @@
+# coding: utf-8
+"""Files, which are copied into the home dir instead of linking.
+
+Some programs refuse to read symlinked configs. Globs of such
+files, relative to the env's root, are listed in the .dotcopy
+file of the env.
+
+Copies are kept in the same .created-links store as links. Together
+with the source, it remembers sizes and mtimes of the source and
+of the copy and a hash of the content, so unchanged copies are
+recognized with two stats and without reading files.
+"""
+from __future__ import absolute_import
+
+import os
+
+from fnmatch import fnmatch
+
+
+COPY_FILENAME = '.dotcopy'
+
+
+def read_copy_patterns(env_path):
+    """Returns globs from the .dotcopy of the env."""
+    filename = os.path.join(env_path, COPY_FILENAME)
+    patterns = []
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            for line in f:
+                pattern = line.strip()
+                if pattern and not pattern.startswith('#'):
+                    patterns.append(pattern)
+    return patterns
+
+
+def is_copied(path, patterns):
+    """Checks if path (tuple of components relative to
+    the env's root) matches one of patterns."""
+    path = '/'.join(path)
+    return any(fnmatch(path, pattern) for pattern in patterns)
+
+
+class CopiedFile(str):
+    """Source of a copy, as it is kept in created links, with
+    (size, mtime) of the source and of the copy, made when the
+    copy was checked last time, and sha1 of the content."""
+
+    def __new__(cls, source, source_info, target_info, sha1):
+        copied = str.__new__(cls, source)
+        copied.source_info = tuple(source_info)
+        copied.target_info = tuple(target_info)
+        copied.sha1 = sha1
+        return copied
+
+    def __reduce__(self):
+        return (CopiedFile, (str(self), self.source_info,
+                             self.target_info, self.sha1))
+
+    def format(self):
+        return '{0} {1[0]} {1[1]} {2[0]} {2[1]} {3}'.format(
+            self, self.source_info, self.target_info, self.sha1)
+
+    @classmethod
+    def parse(cls, text):
+        source, source_size, source_mtime, target_size, target_mtime, sha1 = \
+            text.rsplit(' ', 5)
+        return cls(source,
+                   (int(source_size), int(source_mtime)),
+                   (int(target_size), int(target_mtime)),
+                   sha1)
+
+    def is_modified(self, fs, target):
+        """Checks if the copy was changed in the home dir,
+        so it shouldn't be overwritten."""
+        return (fs.get_file_info(target) != self.target_info
+                and fs.hash_file(target) != self.sha1)
+
+    def is_source_changed(self, fs):
+        """Checks if the source was changed since it was copied.
+        Content is hashed only if size or mtime was changed."""
+        info = fs.get_file_info(str(self))
+        if info == self.source_info:
+            return False
+        return info is None or fs.hash_file(str(self)) != self.sha1
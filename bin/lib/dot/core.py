@@ -1,16 +1,41 @@
 # coding: utf-8
 from __future__ import absolute_import
 
+import json
 import os
 import re
 import subprocess
 import sys
-
+import threading
+import time
+
+from collections import defaultdict, Counter
+from contextlib import ExitStack
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
+from functools import partial
 from itertools import groupby
+from . import phases
+from .copies import CopiedFile, read_copy_patterns, is_copied, COPY_FILENAME
+from .history import HistoryRecorder, append_record, read_history, format_stats
+from .hooks import run_hooks, HOOKS_FILENAME
+from .memory_profile import MemoryProfiler
+from .metrics import write_metrics, get_update_metrics, get_status_metrics
+from .mirrors import refresh_mirror, get_mirror_path, borrows_from
+from .plan_cache import PlanCache, RecordingFS
+from .plan_file import write_plan, read_plan, check_preconditions
 from .real_filesystem import RealFS
+from .snapshot_fs import SnapshotFS, get_touched_dirs
+from .trace import TraceRecorder
 from .virtual_fs import VirtualFS
 from .logging import (log_mkdir, log_link, log_verbose,
-                      log_error, log_rm)
+                      log_warning, log_error, log_rm)
+
+
+CREATED_LINKS_FILENAME = '.created-links'
+PLAN_CACHE_FILENAME = '.plan-cache'
+# urls of envs, which the env depends on, one per line
+DEPENDENCIES_FILENAME = '.dotdepends'
 
 
 class File(object):
@@ -32,7 +57,7 @@ class File(object):
 class Dir(object):
     def __init__(self, name, envs, children=None):
         self.name = name
-        self.envs = list(set(envs))
+        self.envs = sorted(set(envs))
         self.children = children or []
 
     def __repr__(self):
@@ -70,6 +95,20 @@ def processor_real(actions, created_links, fs):
         log_verbose('Symlink from {0} to {1} already exists'.format(
             target, source))
 
+    def copy(source, target):
+        sha1 = fs.copy(source, target)
+        new_created_links[target] = CopiedFile(
+            source, fs.get_file_info(source), fs.get_file_info(target), sha1)
+        log_link('File {0} was copied to {1}'.format(source, target))
+
+    def already_copied(source, target):
+        # remember new mtimes, to not hash files next time
+        copied = created_links.get(target)
+        sha1 = copied.sha1 if isinstance(copied, CopiedFile) else fs.hash_file(target)
+        new_created_links[target] = CopiedFile(
+            source, fs.get_file_info(source), fs.get_file_info(target), sha1)
+        log_verbose('Copy of {0} at {1} is up to date'.format(source, target))
+
     def error(message):
         log_error(message)
 
@@ -85,6 +124,8 @@ def processor_dry(actions, created_links, fs):
                'link': (log_link, 'Symlink from  {1} to {0} will be created'),
                'already-linked': (
                    log_verbose, 'Symlink from {1} to {0} already exists'),
+               'copy': (log_link, 'File {0} will be copied to {1}'),
+               'already-copied': (log_verbose, 'Copy of {0} at {1} is up to date'),
                'error': (log_error, '{0}'),
                'rm': (log_rm, 'Symlink {0} will be removed.')}
     for action in actions:
@@ -104,15 +145,15 @@ def create_tree_from_text(text):
     lines.sort(key=lambda x: x[1:])
 
     # extract environments, they are first level directories
-    envs = map(head, lines)
-    lines = map(tail, lines)
+    envs = list(map(head, lines))
+    lines = list(map(tail, lines))
 
     # now, each item in lines will be tuple, where second item it's env
-    lines = zip(lines, envs)
+    lines = list(zip(lines, envs))
     extract_envs = lambda lines: [line[1] for line in lines]
 
     def process(*lines):
-        if not filter(lambda x: x[0][0], lines):
+        if not [line for line in lines if line[0][0]]:
             return ()
         else:
 
@@ -123,20 +164,20 @@ def create_tree_from_text(text):
 
             # here is we are doing woodoo magick with items in pipeline
             grouped = [(key,
-                        filter(lambda x: x[0], [(tail(item[0]), item[1]) for item in items]),
+                        [(tail(item[0]), item[1]) for item in items if tail(item[0])],
                         extract_envs(items))
                        for key, items in grouped]
 
             grouped = [Dir(key, envs, children=process(*reminder)) if reminder else File(key, envs)
                        for key, reminder, envs in grouped]
-            grouped = filter(None, grouped)
-            return grouped
+            return [item for item in grouped if item]
 
     return process(*lines)
 
 
-def create_tree_from_filesystem(base_dir, envs):
-    ignored_dirs = {'.git'}
+def _read_ignored_files(base_dir):
+    """Reads .dotignore from the base_dir and returns compiled regex
+    to match file names which should not be linked."""
     # read ignored files from file.
     ignored_files_config = os.path.join(base_dir, '.dotignore')
     ignored_files = []
@@ -150,29 +191,269 @@ def create_tree_from_filesystem(base_dir, envs):
                     ignored_files.append(file_name)
 
     ignored_files = '(' + "|".join(ignored_files) + ')$' #format for regex
-    ignored_files_re = re.compile(ignored_files, re.I)
+    return re.compile(ignored_files, re.I)
+
+
+# .git is a directory in repositories, but a file in their
+# submodules and in worktrees, and neither of them is linked
+IGNORED_DIRS = {'.git'}
+# mode of submodules in the git index
+GITLINK_MODE = '160000'
 
-    base_dir_len = len(base_dir)
-    text = u''
-    for env in envs:
-        env_path = os.path.join(base_dir, env)
 
-        for root, dirs, files in os.walk(env_path):
-            dirs[:] = [d for d in dirs if d not in ignored_dirs]
-            files[:] = [f for f in files if ignored_files_re.match(f) is None]
+def _walk_subtree(path, ignored_files_re, dir_mtimes=None):
+    """Returns full paths of all not ignored files under the path.
+    If dir_mtimes dict is given, it is filled with mtimes of
+    all walked directories."""
+    results = []
+    with phases.phase('scan', path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if d not in IGNORED_DIRS]
+            if dir_mtimes is not None:
+                dir_mtimes[root] = os.stat(root).st_mtime_ns
+            results.extend(os.path.join(root, filename)
+                           for filename in files
+                           if filename not in IGNORED_DIRS
+                           and ignored_files_re.match(filename) is None)
+    return results
 
-            for filename in files:
-                full_path = os.path.join(root, filename)
-                text += full_path[base_dir_len + 1:]
-                text += u'\n'
 
+def _list_tracked_files(env_path, ignored_files_re, prefixes=None,
+                        dir_mtimes=None):
+    """Returns full paths of not ignored files from the git index
+    of the env, or None if env is not a git repository.
+
+    Reading the index is much cheaper than listing every directory
+    and skips untracked build results and editor's temporary files.
+    Submodules are in the index as gitlinks, not files, so their
+    checkouts are walked instead.
+    """
+    index_path = os.path.join(env_path, '.git', 'index')
+    if not os.path.isfile(index_path):
+        return None
+
+    command = ['git', '-C', env_path, 'ls-files', '--stage', '-z']
+    if prefixes:
+        command.append('--')
+        command.extend(prefix.replace(os.sep, '/') for prefix in prefixes)
+
+    with phases.phase('scan', env_path):
+        process = subprocess.Popen(command,
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   encoding='utf-8')
+        stdout = process.stdout.read()
+        if process.wait() != 0:
+            return None
+
+    if dir_mtimes is not None:
+        # the index is rewritten each time when files are added or removed
+        dir_mtimes[index_path] = os.stat(index_path).st_mtime_ns
+
+    paths = []
+    for entry in stdout.split('\0'):
+        if not entry:
+            continue
+        # entry is "<mode> <object> <stage>\t<path>"
+        info, path = entry.split('\t', 1)
+        if info.startswith(GITLINK_MODE + ' '):
+            paths.extend(_walk_subtree(os.path.join(env_path, *path.split('/')),
+                                       ignored_files_re, dir_mtimes))
+            continue
+        if ignored_files_re.match(path.rsplit('/', 1)[-1]) is None:
+            path = os.path.join(env_path, *path.split('/'))
+            # unmerged files have an entry for each stage
+            if not paths or paths[-1] != path:
+                paths.append(path)
+    return paths
+
+
+def create_tree_from_filesystem(base_dir, envs, **options):
+    """Walks all envs and builds a tree of their files.
+    Accepts the same options as scan_envs."""
+    return create_tree_from_paths(base_dir, scan_envs(base_dir, envs, **options))
+
+
+def create_tree_from_paths(base_dir, paths):
+    """Builds a tree from sorted full paths of files in envs."""
+    base_dir_len = len(base_dir)
+    text = u''.join(path[base_dir_len + 1:] + u'\n' for path in paths)
     return create_tree_from_text(text)
 
 
-def create_install_actions(base_dir, home_dir, tree, filesystem):
+def scan_envs(base_dir, envs, jobs=None, dir_mtimes=None,
+              prefixes=None, tracked_only=False):
+    """Walks all envs and returns sorted full paths of their files.
+
+    Each env and each top level directory inside of it are scanned
+    on a thread pool of `jobs` workers, because listing directories
+    is dominated by latency on network filesystems and cold caches.
+    Results are sorted before building the tree, so it is the same
+    regardless of the order in which workers finished.
+
+    If `dir_mtimes` dict is given, it is filled with mtimes of all
+    scanned directories, which allows to check later if the tree
+    is still fresh without listing these directories again.
+
+    If `prefixes` are given, only these paths relative to the
+    env's root are scanned.
+
+    If `tracked_only` is True, files of envs which are git repositories
+    are taken from the git index instead of walking directories.
+    """
+    ignored_files_re = _read_ignored_files(base_dir)
+    paths = []
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+
+        def scan(path):
+            futures.append(executor.submit(
+                _walk_subtree, path, ignored_files_re, dir_mtimes))
+
+        tracked = {}
+        if tracked_only:
+            tracked = dict(
+                (env, executor.submit(_list_tracked_files,
+                                      os.path.join(base_dir, env),
+                                      ignored_files_re, prefixes, dir_mtimes))
+                for env in envs)
+
+        for env in envs:
+            env_path = os.path.join(base_dir, env)
+            if not os.path.isdir(env_path):
+                continue
+
+            if env in tracked:
+                files = tracked[env].result()
+                if files is not None:
+                    paths.extend(files)
+                    continue
+
+            if prefixes:
+                for prefix in prefixes:
+                    path = os.path.join(env_path, prefix)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        scan(path)
+                    elif (os.path.lexists(path)
+                          and ignored_files_re.match(os.path.basename(path)) is None):
+                        paths.append(path)
+                continue
+
+            if dir_mtimes is not None:
+                dir_mtimes[env_path] = os.stat(env_path).st_mtime_ns
+
+            for entry in os.scandir(env_path):
+                if entry.is_dir():
+                    # like os.walk, we don't follow symlinks to directories
+                    if entry.name not in IGNORED_DIRS and not entry.is_symlink():
+                        scan(entry.path)
+                elif (entry.name not in IGNORED_DIRS
+                      and ignored_files_re.match(entry.name) is None):
+                    paths.append(entry.path)
+
+        for future in futures:
+            paths.extend(future.result())
+
+    # manifests of dependencies and hooks are not linked
+    manifests = set(os.path.join(base_dir, env, filename)
+                    for env in envs
+                    for filename in (DEPENDENCIES_FILENAME, HOOKS_FILENAME,
+                                     COPY_FILENAME))
+    paths = [path for path in paths if path not in manifests]
+    paths.sort()
+    return paths
+
+
+def _is_under(path, prefixes):
+    """Checks if path (tuple of components) is one of the
+    prefixes or is inside of one of them."""
+    return any(path[:len(prefix)] == prefix for prefix in prefixes)
+
+
+def add_unscanned_envs(base_dir, tree, all_envs, envs, prefixes=None):
+    """Makes tree, built only from some envs and prefixes, to have
+    the same envs in each node as a tree of all envs would have.
+
+    Without this, a directory shared with some not scanned env would
+    be linked as a whole and file conflicts would go unnoticed. We only
+    need to check paths which weren't scanned, and don't have to go
+    deeper than a directory, missing in other envs.
+    """
+    prefixes = [tuple(prefix.split(os.sep)) for prefix in prefixes or []]
+
+    def process(items, path):
+        for item in items:
+            item_path = path + (item.name,)
+            fully_scanned = not prefixes or _is_under(item_path, prefixes)
+            for env in all_envs:
+                if env in item.envs or (env in envs and fully_scanned):
+                    continue
+                if os.path.lexists(os.path.join(base_dir, env, *item_path)):
+                    item.envs = sorted(item.envs + [env])
+
+            children = getattr(item, 'children', None)
+            if children and len(item.envs) > 1:
+                process(children, item_path)
+
+    process(tree, ())
+    return tree
+
+
+def create_install_actions(base_dir, home_dir, tree, filesystem,
+                           plan_cache=None, relative=False,
+                           copy_patterns=None, created_links=None):
+    """Returns actions to link files from the tree into the home_dir.
+
+    If plan_cache is given, actions for top level items of the tree
+    which didn't change since the previous run are taken from it.
+    Home directories of a real filesystem are listed once before
+    planning, see SnapshotFS.
+
+    If relative is True, links should be relative and existing
+    absolute links to the right files are replaced.
+
+    Files matching copy_patterns (dict env -> globs) are copied
+    instead of linking. Created links are needed to find out
+    which files were copied before.
+    """
+    copy_patterns = copy_patterns or {}
+    created_links = created_links or {}
     actions = []
+    pushed_actions = set()
+    if getattr(filesystem, 'can_scandir', False):
+        filesystem = SnapshotFS(filesystem, get_touched_dirs(home_dir, tree))
+    if plan_cache is not None:
+        filesystem = plan_cache.recording(filesystem)
     vfs = VirtualFS(filesystem)
 
+    # intermediate directories already checked during this run:
+    # path -> (exists, absolute symlink_target or None)
+    ancestors = {}
+    # path -> cached paths inside of it, to invalidate them together
+    cached_descendants = defaultdict(set)
+
+    def forget(path):
+        ancestors.pop(path, None)
+        for descendant in cached_descendants.pop(path, ()):
+            ancestors.pop(descendant, None)
+
+    def ancestor_status(dirname):
+        status = ancestors.get(dirname)
+        if status is None:
+            exists = vfs.exists(dirname)
+            symlink_target = None
+            if exists and vfs.is_symlink(dirname):
+                # relative links are resolved the same way as in process()
+                symlink_target = os.path.normpath(os.path.join(
+                    os.path.dirname(dirname), vfs.get_symlink_target(dirname)))
+            status = ancestors[dirname] = (exists, symlink_target)
+
+            parent = os.path.dirname(dirname)
+            while parent != os.path.dirname(parent):
+                cached_descendants[parent].add(dirname)
+                parent = os.path.dirname(parent)
+        return status
+
     def push_action(action, *args):
         action = (action,) + args
 
@@ -180,8 +461,10 @@ def create_install_actions(base_dir, home_dir, tree, filesystem):
         # virtual filesystem to get actual view
         if action[0] in ('rm', 'mkdir', 'link'):
             getattr(vfs, action[0])(*action[1:])
+            forget(action[-1])
 
-        if len(list(filter(lambda a: a == action, actions))) == 0:
+        if action not in pushed_actions:
+            pushed_actions.add(action)
             actions.append(action)
 
     def push_actions(actions):
@@ -207,11 +490,88 @@ def create_install_actions(base_dir, home_dir, tree, filesystem):
                     yield (prefix + (item.name,),
                            item.envs,
                            [])
+            elif children and has_copies(item, new_prefix, item.envs[0]):
+                # directory can't be linked, if some files inside
+                # of it should be copied
+                for result in walk(children, prefix=new_prefix):
+                    yield result
             else:
                 yield (new_prefix,
                        item.envs,
                        walk(children, prefix=new_prefix))
 
+    def has_copies(item, path, env):
+        if env not in copy_patterns:
+            return False
+        children = getattr(item, 'children', None)
+        if children is None:
+            return is_copied(path, copy_patterns[env])
+        return any(has_copies(child, path + (child.name,), env)
+                   for child in children)
+
+    def create_intermediate_dirs(path):
+        """Adds actions to create all intermediate directories,
+        but only if there isn't such actions already. Returns
+        False if some of them couldn't be created."""
+        mkdirs = []
+        # from the top, because replacing of a symlinked directory
+        # changes what is inside of it
+        for i in range(len(path) - 1, 0, -1):
+            dirname = os.path.join(home_dir, *path[:-i])
+            dir_exists, dir_symlink_target = ancestor_status(dirname)
+
+            if dir_exists:
+                if dir_symlink_target is not None:
+                    if dir_symlink_target.startswith(base_dir):
+                        push_action('rm', dirname)
+                        push_action('mkdir', dirname)
+                    else:
+                        push_action('error', 'Intermediate directory {0} is a symlink to {1}, please remove it manually.'.format(
+                            dirname, dir_symlink_target))
+                        return False
+            else:
+                action = ('mkdir', dirname)
+                if action not in pushed_actions:
+                    mkdirs.append(action)
+
+        push_actions(mkdirs)
+        return True
+
+    def process_copy(path, source, target):
+        in_symlinked_directory = any(
+            ancestor_status(os.path.join(home_dir, *path[:-i]))[1] is not None
+            for i in range(1, len(path)))
+
+        if vfs.exists(target) and not in_symlinked_directory:
+            if vfs.is_symlink(target):
+                symlink_target = os.path.normpath(os.path.join(
+                    os.path.dirname(target), vfs.get_symlink_target(target)))
+                if not symlink_target.startswith(base_dir):
+                    push_action('error', 'File {0} is a symlink to {1}, please, remove it manually if you really want to replace it.'.format(
+                        target, symlink_target))
+                    return
+                # file was linked before
+                push_action('rm', target)
+            else:
+                copied = created_links.get(target)
+                if not isinstance(copied, CopiedFile):
+                    push_action('error', 'File {0} already exists, can\'t copy {1} instead of it.'.format(
+                        target, source))
+                    return
+
+                if copied.is_modified(filesystem, target):
+                    push_action('error', 'File {0} was changed after it was copied from {1}, please, remove it manually if you really want to replace it.'.format(
+                        target, source))
+                elif copied != source or copied.is_source_changed(filesystem):
+                    # source was changed or moved to another env
+                    push_action('copy', source, target)
+                else:
+                    push_action('already-copied', source, target)
+                return
+
+        if create_intermediate_dirs(path):
+            push_action('copy', source, target)
+
     def process(path, envs, alternatives):
         if len(envs) > 1:
             push_action('error', 'File {0} exists in more then one environments: {1}'.format(
@@ -220,6 +580,10 @@ def create_install_actions(base_dir, home_dir, tree, filesystem):
             source = os.path.join(base_dir, envs[0], *path)
             target = os.path.join(home_dir, *path)
 
+            if envs[0] in copy_patterns and is_copied(path, copy_patterns[envs[0]]):
+                process_copy(path, source, target)
+                return
+
             # log_verbose('Checking if {target} can be linked to {source}'.format(
             #     target=target,
             #     source=source))
@@ -228,17 +592,37 @@ def create_install_actions(base_dir, home_dir, tree, filesystem):
                 exists = vfs.exists(target)
                 is_symlink = exists and vfs.is_symlink(target)
 
-                target_dir = os.path.dirname(target)
-                in_symlinked_directory = vfs.realpath(target_dir) != target_dir
-
-                realpath = vfs.realpath(target)
-                already_linked = exists and realpath == source
+                # intermediate directories are checked once per run, so
+                # resolving of the whole path is needed only when one of
+                # them is a symlink
+                in_symlinked_directory = any(
+                    ancestor_status(os.path.join(home_dir, *path[:-i]))[1] is not None
+                    for i in range(1, len(path)))
 
                 symlink_target = vfs.get_symlink_target(target) if is_symlink else None
+                raw_symlink_target = symlink_target
+                if symlink_target is not None:
+                    symlink_target = os.path.normpath(
+                        os.path.join(os.path.dirname(target), symlink_target))
+
+                already_linked = symlink_target == source
+                relink = (relative and already_linked
+                          and raw_symlink_target != os.path.relpath(source, os.path.dirname(target)))
+                if relink:
+                    already_linked = False
+                if (is_symlink and not already_linked and not in_symlinked_directory
+                        and not symlink_target.startswith(base_dir)):
+                    # a chain of symlinks, which could end at the source
+                    try:
+                        already_linked = vfs.realpath(target) == source
+                    except OSError:
+                        # symlink loop
+                        already_linked = False
+
                 symlink_outside_base_dir = is_symlink and not symlink_target.startswith(base_dir)
                 symlink_to_some_other_dotfile = (is_symlink
                                                  and symlink_target.startswith(base_dir)
-                                                 and symlink_target != source)
+                                                 and (symlink_target != source or relink))
 
 
 
@@ -250,30 +634,7 @@ def create_install_actions(base_dir, home_dir, tree, filesystem):
                         target, symlink_target))
 
                 elif not exists or symlink_to_some_other_dotfile or in_symlinked_directory:
-                    # now, add actions to create all intermediate directories
-                    # but only if there isn't such actions already
-                    mkdirs = []
-                    for i in range(1, len(path)):
-                        dirname = os.path.join(home_dir, *path[:-i])
-
-                        if vfs.exists(dirname):
-                            if vfs.is_symlink(dirname):
-                                symlink_target = vfs.get_symlink_target(dirname)
-                                if symlink_target.startswith(base_dir):
-                                    push_action('rm', dirname)
-                                    push_action('mkdir', dirname)
-                                else:
-                                    push_action('error', 'Intermediate directory {0} is a symlink to {1}, please remove it manually.'.format(
-                                        dirname, symlink_target))
-                                    break
-                        else:
-                            action = ('mkdir', dirname)
-                            if action not in actions:
-                                mkdirs.insert(0, action)
-
-                    if not actions or actions[-1][0] != 'error':
-                        push_actions(mkdirs)
-
+                    if create_intermediate_dirs(path):
                         if symlink_to_some_other_dotfile:
                             push_action('rm', target)
 
@@ -347,8 +708,140 @@ def create_install_actions(base_dir, home_dir, tree, filesystem):
                         push_actions(mkdirs)
                         push_action('link', source, target)
 
-    for item in walk(tree):
-        process(*item)
+    for top_item in tree:
+        with phases.phase('plan', top_item.name):
+            if plan_cache is None:
+                for item in walk([top_item]):
+                    process(*item)
+                continue
+
+            key = plan_cache.key(top_item)
+            cached_actions = plan_cache.get(key)
+            if cached_actions is not None:
+                push_actions(cached_actions)
+            else:
+                start = len(actions)
+                filesystem.paths.clear()
+                for item in walk([top_item]):
+                    process(*item)
+                plan_cache.put(key, top_item.name, actions[start:], filesystem.paths)
+
+    return actions
+
+
+def _count_files(item):
+    children = getattr(item, 'children', None)
+    if children is None:
+        return 1
+    return sum(map(_count_files, children))
+
+
+def _count_conflicts(item):
+    """Counts files which exist in more than one env."""
+    children = getattr(item, 'children', None)
+    if not children:
+        return 1 if len(item.envs) > 1 else 0
+    return sum(map(_count_conflicts, children))
+
+
+def _split_into_units(tree):
+    """Splits top level items into units, which could be planned
+    independently. Directories merged from many envs, like ~/.config,
+    are split by their children, everything else is a unit itself.
+    Returns list of (top level index, unit)."""
+    units = []
+    for index, item in enumerate(tree):
+        children = getattr(item, 'children', [])
+        if len(item.envs) > 1 and children:
+            units.extend((index, Dir(item.name, item.envs, [child]))
+                         for child in children)
+        else:
+            units.append((index, item))
+    return units
+
+
+def _plan_shard(base_dir, home_dir, units, options):
+    """Plans units in a worker process. Returns a list of tuples
+    (actions, paths), where paths are home paths looked at while
+    planning the unit. Options are passed to create_install_actions."""
+    fs = SnapshotFS(RealFS(), get_touched_dirs(home_dir, units))
+    results = []
+    for unit in units:
+        recording_fs = RecordingFS(fs)
+        actions = create_install_actions(base_dir, home_dir, [unit],
+                                         recording_fs, **options)
+        results.append((actions, sorted(recording_fs.paths)))
+    return results
+
+
+def create_install_actions_sharded(base_dir, home_dir, tree, shards,
+                                   plan_cache=None, **options):
+    """Same as create_install_actions for a real filesystem, but plans
+    in several worker processes.
+
+    Units of the tree are distributed among shards by number of files
+    and actions are merged in the order of the tree, so the result
+    doesn't depend on which worker finished first. Intermediate
+    directories shared by units, like ~/.config, are checked by every
+    unit, and duplicates of their actions are dropped during the merge.
+    """
+    cached = {}
+    if plan_cache is not None:
+        for index, item in enumerate(tree):
+            cached_actions = plan_cache.get(plan_cache.key(item))
+            if cached_actions is not None:
+                cached[index] = cached_actions
+
+    units = [(index, unit)
+             for index, unit in _split_into_units(tree)
+             if index not in cached]
+
+    # the largest units first, each one to the least loaded shard
+    loads = [[0, []] for i in range(shards)]
+    for number in sorted(range(len(units)),
+                         key=lambda number: -_count_files(units[number][1])):
+        load = min(loads, key=lambda load: load[0])
+        load[0] += _count_files(units[number][1])
+        load[1].append(number)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=shards) as executor:
+        futures = dict(
+            (executor.submit(_plan_shard, base_dir, home_dir,
+                             [units[number][1] for number in numbers],
+                             options),
+             numbers)
+            for size, numbers in loads if numbers)
+        for future, numbers in futures.items():
+            results.update(zip(numbers, future.result()))
+
+    actions = []
+    pushed_actions = set()
+
+    def push_actions(new_actions):
+        for action in new_actions:
+            action = tuple(action)
+            if action not in pushed_actions:
+                pushed_actions.add(action)
+                actions.append(action)
+
+    for index, item in enumerate(tree):
+        if index in cached:
+            push_actions(cached[index])
+            continue
+
+        start = len(actions)
+        item_paths = set()
+        for number, (unit_index, unit) in enumerate(units):
+            if unit_index == index:
+                unit_actions, unit_paths = results[number]
+                push_actions(unit_actions)
+                item_paths.update(unit_paths)
+
+        item_actions = actions[start:]
+        if plan_cache is not None:
+            plan_cache.put(plan_cache.key(item), item.name,
+                           item_actions, item_paths)
     return actions
 
 
@@ -358,12 +851,21 @@ def create_actions_to_remove_broken_symlinks(created_links, fs):
     """
     results = []
 
-    for source, target in created_links.items():
-        if fs.exists(source) \
-           and fs.is_symlink(source) \
-           and fs.realpath(source) == target \
-           and not fs.exists(target):
-            results.append(('rm', source))
+    with phases.phase('fs-batch', 'check {0} created links'.format(len(created_links))):
+        for source, target in created_links.items():
+            if isinstance(target, CopiedFile):
+                # copies of removed files are removed too,
+                # if they weren't changed in the home dir
+                if not fs.exists(target) \
+                   and fs.get_file_info(source) == target.target_info:
+                    results.append(('rm', source))
+                continue
+
+            if fs.exists(source) \
+               and fs.is_symlink(source) \
+               and fs.realpath(source) == target \
+               and not fs.exists(target):
+                results.append(('rm', source))
 
     return results
 
@@ -379,78 +881,849 @@ def _get_envs(base_dir):
     return envs
 
 
-def _current_env_has_remote_upstream():
-    """Returns True, if repository at CWD has at least one
-    remote upstream."""
-    if os.path.exists('.git'):
+def _select(base_dir, home_dir, args):
+    """Returns a tuple (envs, prefixes), where envs is a list of envs
+    given in the command line or all envs, and prefixes is a list of
+    paths relative to the home_dir, given with --only, or None.
+    """
+    envs = _get_envs(base_dir)
+
+    selected_envs = args.get('<env>') or envs
+    for env in selected_envs:
+        if env not in envs:
+            raise RuntimeError('Environment "{0}" not found in {1}'.format(
+                env, base_dir))
+
+    prefixes = None
+    if args.get('--only'):
+        prefixes = []
+        for path in args['--only']:
+            path = os.path.abspath(os.path.expanduser(path))
+            relative = os.path.relpath(path, home_dir)
+            if relative == os.curdir:
+                # the whole home dir was given
+                prefixes = None
+                break
+            if relative.startswith(os.pardir):
+                raise RuntimeError('Path {0} is not inside {1}'.format(
+                    path, home_dir))
+            prefixes.append(relative)
+
+    return selected_envs, prefixes
+
+
+def _filter_created_links(created_links, base_dir, home_dir, envs, prefixes):
+    """Returns only created links which belong to given envs and are
+    inside of given prefixes or are their ancestors."""
+    sources = tuple(os.path.join(base_dir, env) + os.sep for env in envs)
+    targets = tuple(os.path.join(home_dir, prefix)
+                    for prefix in prefixes or [''])
+
+    def is_selected(target, source):
+        # links to the ancestors of prefixes are taken too, because
+        # they become broken when the last file inside is removed
+        return (source.startswith(sources)
+                and any(target == prefix
+                        or target.startswith(prefix.rstrip(os.sep) + os.sep)
+                        or prefix.startswith(target + os.sep)
+                        for prefix in targets))
+
+    return dict((target, source)
+                for target, source in created_links.items()
+                if is_selected(target, source))
+
+
+def _get_jobs(args):
+    """Returns number of parallel workers requested with --jobs
+    or None to let the executor choose."""
+    jobs = args.get('--jobs')
+    return int(jobs) if jobs else None
+
+
+def _get_shards(args):
+    """Returns number of processes for planning requested with --shards."""
+    shards = args.get('--shards')
+    return int(shards) if shards else 1
+
+
+def _get_mirror_dir(args):
+    """Returns directory with shared mirrors of envs from --mirror-dir
+    or DOT_MIRROR_DIR environment variable, or None."""
+    return args.get('--mirror-dir') or os.environ.get('DOT_MIRROR_DIR') or None
+
+
+def _current_env_has_remote_upstream(cwd=None):
+    """Returns True, if repository at CWD (or at given cwd)
+    has at least one remote upstream."""
+    if os.path.exists(os.path.join(cwd or os.curdir, '.git')):
         process = subprocess.Popen(['git', 'remote'],
                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                   encoding='utf-8')
+                                   encoding='utf-8', cwd=cwd)
         stdout = process.stdout.read()
+        process.wait()
         return bool(stdout)
     return False
 
 
-def make_pull(base_dir, env):
-    pwd = os.getcwd()
+def _git_output(*args, cwd=None):
+    """Runs git command at CWD (or at given cwd) and returns
+    its output or None if it failed."""
+    process = subprocess.Popen(('git',) + args,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               encoding='utf-8', cwd=cwd)
+    stdout = process.stdout.read()
+    if process.wait() != 0:
+        return None
+    return stdout
+
+
+def _get_sparse_patterns(env_path, ignored_files_re, revision='HEAD'):
+    """Returns sparse-checkout patterns, which exclude files ignored
+    by .dotignore, or None if revision can't be read.
+
+    Directories where all files are ignored are excluded as a whole,
+    to keep the list of patterns short. Files like .gitmodules and
+    .gitattributes are always checked out, because git needs them.
+    """
+    output = _git_output('ls-tree', '-r', '--name-only', '-z', revision,
+                         cwd=env_path)
+    if output is None:
+        return None
+
+    files = [path for path in output.split('\0') if path]
+    total = defaultdict(int)
+    ignored = defaultdict(int)
+    ignored_files = []
+
+    for path in files:
+        name = path.rsplit('/', 1)[-1]
+        is_ignored = (not name.startswith('.git')
+                      and ignored_files_re.match(name) is not None)
+        if is_ignored:
+            ignored_files.append(path)
+
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            dirname = '/'.join(parts[:i])
+            total[dirname] += 1
+            if is_ignored:
+                ignored[dirname] += 1
+
+    def excluded_dir(path):
+        """Returns topmost ancestor dir, where all files are ignored."""
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            dirname = '/'.join(parts[:i])
+            if ignored[dirname] == total[dirname]:
+                return dirname
+        return None
+
+    def escape(path):
+        return re.sub(r'([*?\[\\!# ])', r'\\\1', path)
+
+    patterns = ['/*']
+    excluded_dirs = set()
+    for path in ignored_files:
+        dirname = excluded_dir(path)
+        if dirname is None:
+            patterns.append('!/' + escape(path))
+        elif dirname not in excluded_dirs:
+            excluded_dirs.add(dirname)
+            patterns.append('!/' + escape(dirname) + '/')
+    return patterns
+
+
+def _set_sparse_checkout(env_path, patterns):
+    """Applies sparse-checkout patterns to the env, removing
+    excluded files from its working tree."""
+    process = subprocess.Popen(['git', 'sparse-checkout', 'set', '--no-cone', '--stdin'],
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                               encoding='utf-8', cwd=env_path)
+    process.communicate(''.join(pattern + '\n' for pattern in patterns))
+    return process.wait() == 0
+
+
+def _is_sparse(env_path):
+    if not os.path.exists(os.path.join(env_path, '.git', 'info', 'sparse-checkout')):
+        return False
+    value = _git_output('config', '--get', 'core.sparseCheckout', cwd=env_path)
+    return value is not None and value.strip() == 'true'
+
+
+def _update_submodule(env_path, path):
+    """Updates one submodule, trying a shallow fetch first.
+    Returns a tuple (path, success, seconds)."""
+    started_at = time.time()
+    command = ['git', 'submodule', 'update', '--recursive', '--quiet']
+    success = subprocess.call(command + ['--depth', '1', '--', path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              cwd=env_path) == 0
+    if not success:
+        # server could refuse to give a commit which is not a tip of any branch
+        success = subprocess.call(command + ['--', path],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  cwd=env_path) == 0
+    return (path, success, time.time() - started_at)
+
+
+def sync_submodules(base_dir, env, jobs=None):
+    """Initializes and updates all submodules of the env in parallel."""
+    env_path = os.path.join(base_dir, env)
+    if not os.path.exists(os.path.join(env_path, '.gitmodules')):
+        return
+
+    output = _git_output('config', '--file', '.gitmodules',
+                         '--get-regexp', r'^submodule\..*\.path$', cwd=env_path)
+    paths = [line.split(' ', 1)[1] for line in (output or '').splitlines()]
+    if not paths:
+        return
+
+    # init changes .git/config, so it can't be done in parallel
+    _git_output('submodule', 'init', cwd=env_path)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_update_submodule, env_path, path)
+                   for path in paths]
+        for future in as_completed(futures):
+            path, success, seconds = future.result()
+            if success:
+                log_verbose('Submodule "{0}" of "{1}" was updated in {2:.2f}s'.format(
+                    path, env, seconds))
+            else:
+                log_error('Unable to update submodule "{0}" of "{1}"'.format(
+                    path, env))
+
+
+def _refresh_mirror(mirror_dir, url):
+    """Returns path to the refreshed mirror of the url or None if
+    it couldn't be refreshed, so the env is pulled without it."""
     try:
-        os.chdir(os.path.join(base_dir, env))
-        if _current_env_has_remote_upstream():
-            log_verbose('Making pull in "{0}":'.format(env))
-            process = subprocess.Popen(['git', 'pull'],
+        return refresh_mirror(mirror_dir, url)
+    except (subprocess.CalledProcessError, OSError) as e:
+        log_warning('Mirror of "{0}" in "{1}" was not refreshed, going without it: {2}'.format(
+            url, mirror_dir, e))
+        return None
+
+
+def make_pull(base_dir, env, sparse=False, submodules=False, jobs=None,
+              mirror_dir=None):
+    """Pulls changes into the env.
+
+    If sparse is True or env already has a sparse checkout,
+    sparse-checkout patterns are updated from .dotignore before
+    the merge, so ignored files are never written to disk.
+
+    If submodules is True, submodules are updated after the pull
+    using `jobs` parallel workers.
+
+    If mirror_dir is given and the env borrows objects from the shared
+    mirror of its remote, the mirror is refreshed before the pull,
+    so objects are fetched once per host.
+
+    Doesn't change CWD, so could be called for different
+    envs in parallel.
+
+    Returns a tuple (old_head, new_head) or None if
+    env has no remote upstream."""
+    env_path = os.path.join(base_dir, env)
+    if _current_env_has_remote_upstream(cwd=env_path):
+        old_head = _git_output('rev-parse', 'HEAD', cwd=env_path)
+
+        if mirror_dir:
+            url = _git_output('config', '--get', 'remote.origin.url', cwd=env_path)
+            # envs cloned without the mirror would only fetch twice
+            if url and borrows_from(env_path, get_mirror_path(mirror_dir, url.strip())):
+                _refresh_mirror(mirror_dir, url.strip())
+
+        if sparse or _is_sparse(env_path):
+            _git_output('fetch', cwd=env_path)
+            patterns = _get_sparse_patterns(env_path,
+                                            _read_ignored_files(base_dir),
+                                            revision='@{upstream}')
+            if patterns is not None:
+                _set_sparse_checkout(env_path, patterns)
+
+        process = subprocess.Popen(['git', 'pull'],
                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                   encoding='utf-8')
-            for line in process.stdout:
-                log_verbose(' ' * 4 + line.strip())
-    finally:
-        os.chdir(pwd)
+                                   encoding='utf-8', cwd=env_path)
+        lines = [' ' * 4 + line.strip() for line in process.stdout]
+        process.wait()
+        # output is logged at once, to not mix it with other pulls
+        log_verbose('\n'.join(['Making pull in "{0}":'.format(env)] + lines))
+
+        if submodules:
+            sync_submodules(base_dir, env, jobs=jobs)
+
+        new_head = _git_output('rev-parse', 'HEAD', cwd=env_path)
+        return (old_head and old_head.strip(),
+                new_head and new_head.strip())
+
+
+def _get_changed_paths(base_dir, env, old_head, new_head):
+    """Returns paths of files added or removed in the env between
+    two commits, or None if it is impossible to tell, for example
+    because history was rewritten.
+
+    Modified files are returned only if they are copied, because
+    links to them are still valid. If the .dotcopy itself was
+    changed, None is returned to plan everything again."""
+    if not old_head or not new_head:
+        return None
+    if old_head == new_head:
+        return []
+
+    env_path = os.path.join(base_dir, env)
+    if _git_output('merge-base', '--is-ancestor', old_head, new_head,
+                   cwd=env_path) is None:
+        return None
+
+    output = _git_output('diff', '--name-status', '--no-renames', '-z',
+                         old_head, new_head, cwd=env_path)
+    if output is None:
+        return None
+
+    # output is a sequence of status and path, separated by zero bytes
+    items = output.split('\0')
+    changes = list(zip(items[::2], items[1::2]))
+    if any(path == COPY_FILENAME for status, path in changes):
+        return None
+
+    copy_patterns = read_copy_patterns(env_path)
+    return sorted(set(path
+                      for status, path in changes
+                      if status in ('A', 'D')
+                      # copies of modified files should be updated
+                      or (status in ('M', 'T')
+                          and is_copied(tuple(path.split('/')), copy_patterns))))
+
+
+def _get_incremental_prefixes(base_dir, envs, heads, prefixes):
+    """Returns prefixes to replan after the pull, or None if
+    the whole tree has to be planned again."""
+    changed = set()
+    for env in envs:
+        if heads.get(env) is None:
+            # env has no upstream and wasn't pulled
+            continue
+        paths = _get_changed_paths(base_dir, env, *heads[env])
+        if paths is None:
+            return None
+        changed.update(paths)
+
+    if prefixes is not None:
+        # respect paths given by user
+        selected = [tuple(prefix.split(os.sep)) for prefix in prefixes]
+        changed = [path for path in changed
+                   if _is_under(tuple(path.split('/')), selected)]
+
+    return sorted(os.path.join(*path.split('/')) for path in changed)
+
+
+def _get_replaced_ancestors(actions, home_dir, prefixes):
+    """Returns dirs, relative to home_dir, which are ancestors of
+    given prefixes and are replaced with real directories. Content of
+    such dirs was linked through the dir symlink and now should be
+    planned as a whole."""
+    mkdirs = set(action[1] for action in actions if action[0] == 'mkdir')
+    results = set()
+    for action in actions:
+        if action[0] == 'rm' and action[1] in mkdirs:
+            relative = os.path.relpath(action[1], home_dir)
+            if any(prefix.startswith(relative + os.sep) for prefix in prefixes):
+                results.add(relative)
+    return sorted(results)
+
+
+def create_actions_pipelined(base_dir, home_dir, envs, fs, pull=True,
+                             jobs=None, tracked_only=False, plan_cache=None,
+                             sparse=False, submodules=False, mirror_dir=None,
+                             **options):
+    """Pulls, scans and plans envs without waiting for each other.
+    Other options are passed to create_install_actions.
+
+    Scan of each env starts right after its pull, and planning of its
+    top level items starts right after the scan, if these items are
+    not present in other envs. When all envs are scanned, early plans
+    of items which turned out to be shared with other envs are thrown
+    away and these items are planned again using the merged tree, so
+    conflicts between envs are always found. Returns the same actions
+    as create_install_actions would return for the merged tree.
+
+    Pull of each env waits for pulls of envs it depends on, like
+    sequential update pulls envs in the order of dependencies.
+    """
+    top_level_names = dict(
+        (env, set(os.listdir(os.path.join(base_dir, env))) - IGNORED_DIRS)
+        for env in envs)
+
+    def is_owned_only_by(name, env):
+        return all(name not in names
+                   for other_env, names in top_level_names.items()
+                   if other_env != env)
+
+    # home is listed once for all plans. Items planned early are
+    # owned by one env, so only home_dir itself is needed for them.
+    snapshot = None
+    if getattr(fs, 'can_scandir', False):
+        fs = snapshot = SnapshotFS(fs, [home_dir])
+
+    # envs are submitted in this order, so dependencies of each env
+    # are already taken by workers when it waits for them
+    envs = _sort_by_dependencies(base_dir, envs)
+    order = dict((env, number) for number, env in enumerate(envs))
+    pulled = dict((env, threading.Event()) for env in envs)
+
+    def pull_and_scan(env):
+        if pull:
+            for dependency in _get_dependencies(base_dir, env):
+                # dependencies which form a cycle are ignored
+                if order.get(dependency, len(envs)) < order[env]:
+                    pulled[dependency].wait()
+            try:
+                with phases.phase('pull', env):
+                    make_pull(base_dir, env, sparse=sparse,
+                              submodules=submodules, jobs=jobs,
+                              mirror_dir=mirror_dir)
+            finally:
+                pulled[env].set()
+        with phases.phase('scan', env):
+            return scan_envs(base_dir, [env], jobs=jobs, tracked_only=tracked_only)
+
+    def plan(item):
+        return create_install_actions(base_dir, home_dir, [item], fs,
+                                      plan_cache=plan_cache, **options)
+
+    paths = []
+    early_plans = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        scans = dict((executor.submit(pull_and_scan, env), env)
+                     for env in envs)
+
+        for future in as_completed(scans):
+            env = scans[future]
+            env_paths = future.result()
+            paths.extend(env_paths)
+            phases.count('files', len(env_paths))
+
+            for item in create_tree_from_paths(base_dir, env_paths):
+                if is_owned_only_by(item.name, env):
+                    early_plans[item.name] = (item, executor.submit(plan, item))
+
+        # all envs are pulled and scanned, now we know the whole tree
+        paths.sort()
+        tree = create_tree_from_paths(base_dir, paths)
+        phases.count('conflicts', sum(map(_count_conflicts, tree)))
+        if snapshot is not None:
+            snapshot.add_dirs(get_touched_dirs(home_dir, tree))
+
+        actions = []
+        for item in tree:
+            early_item, future = early_plans.pop(item.name, (None, None))
+            if early_item == item:
+                actions.extend(future.result())
+            else:
+                actions.extend(plan(item))
 
+    return actions
 
-def update(base_dir, home_dir, args,
-            processor=None,
-            tree_builder=None):
-    dry_run = args['--dry']
-    envs = _get_envs(base_dir)
 
-    if not args['--skip-pull']:
-        for env in envs:
-            make_pull(base_dir, env)
+def _relative_to(path, root):
+    """Returns path relative to the root if it is inside of it,
+    otherwise returns path as is."""
+    relative = os.path.relpath(path, root)
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        return path
+    return relative
+
+
+def read_created_links(base_dir, home_dir):
+    """Reads symlinks created during previous 'dot update' calls.
+    Returns dict target -> source. Sources of copied files are
+    CopiedFile objects.
+
+    Targets are kept relative to the home_dir and sources relative
+    to the base_dir, so links are still known after both of them
+    were moved. Absolute paths, written by older versions, are
+    read as is."""
+    created_links_filename = os.path.join(base_dir, CREATED_LINKS_FILENAME)
+    if not os.path.exists(created_links_filename):
+        return {}
+
+    created_links = {}
+    with open(created_links_filename) as f:
+        for line in f.readlines():
+            line = line.strip()
+            if ' => ' in line:
+                target, copied = line.split(' => ')
+                copied = CopiedFile.parse(copied)
+                source = CopiedFile(os.path.join(base_dir, copied),
+                                    copied.source_info,
+                                    copied.target_info,
+                                    copied.sha1)
+            else:
+                target, source = line.split(' -> ')
+                source = os.path.join(base_dir, source)
+            created_links[os.path.join(home_dir, target)] = source
+    phases.count('state-read', os.path.getsize(created_links_filename))
+    return created_links
+
 
-    # create a files tree
-    if tree_builder is None:
-        tree_builder = create_tree_from_filesystem
-    tree = tree_builder(base_dir, envs)
+def write_created_links(base_dir, home_dir, created_links):
+    def format_link(target, source):
+        target = _relative_to(target, home_dir)
+        if isinstance(source, CopiedFile):
+            copied = CopiedFile(_relative_to(source, base_dir),
+                                source.source_info,
+                                source.target_info,
+                                source.sha1)
+            return '{0} => {1}\n'.format(target, copied.format())
+        return '{0} -> {1}\n'.format(target, _relative_to(source, base_dir))
+
+    created_links_filename = os.path.join(base_dir, CREATED_LINKS_FILENAME)
+    with open(created_links_filename, 'w') as f:
+        f.writelines(format_link(target, source)
+                     for target, source in sorted(created_links.items()))
+    phases.count('state-written', os.path.getsize(created_links_filename))
+
+
+def create_update_actions(base_dir, home_dir, args, fs,
+                          tree_builder=None,
+                          created_links=None):
+    """Pulls envs and returns a tuple (actions, created_links), where
+    actions are needed to remove broken symlinks and to create new ones.
+
+    The `created_links` could be given by a caller, which already
+    has them in memory, otherwise they are read from the base_dir.
+    """
+    all_envs = _get_envs(base_dir)
 
-    fs = RealFS()
+    if created_links is None:
+        created_links = read_created_links(base_dir, home_dir)
+
+    try:
+        envs, prefixes = _select(base_dir, home_dir, args)
+    except RuntimeError as e:
+        log_error(str(e))
+        return [], created_links
+    partial_update = envs != all_envs or prefixes is not None
+
+    # options of create_install_actions, which affect planned actions
+    planning_options = dict(relative=args.get('--relative', False),
+                            copy_patterns=_read_copy_patterns(base_dir, all_envs))
+
+    plan_cache = None
+    if args.get('--plan-cache'):
+        plan_cache = PlanCache(os.path.join(base_dir, PLAN_CACHE_FILENAME),
+                               base_dir, home_dir, fs,
+                               options=planning_options)
+
+    if (args.get('--pipeline')
+            and not partial_update
+            and not args.get('--incremental')):
+        with phases.phase('pipeline'):
+            actions = create_actions_pipelined(
+                base_dir, home_dir, envs, fs,
+                pull=not args['--skip-pull'],
+                jobs=_get_jobs(args),
+                tracked_only=args.get('--tracked-only', False),
+                plan_cache=plan_cache,
+                sparse=args.get('--sparse', False),
+                submodules=args.get('--submodules', False),
+                mirror_dir=_get_mirror_dir(args),
+                created_links=created_links,
+                **planning_options)
+    else:
+        heads = {}
+        if not args['--skip-pull']:
+            with phases.phase('pull'):
+                for env in _sort_by_dependencies(base_dir, envs):
+                    with phases.phase('pull', env):
+                        heads[env] = make_pull(base_dir, env,
+                                               sparse=args.get('--sparse', False),
+                                               submodules=args.get('--submodules', False),
+                                               jobs=_get_jobs(args),
+                                               mirror_dir=_get_mirror_dir(args))
+
+            if args.get('--incremental'):
+                changed = _get_incremental_prefixes(base_dir, envs, heads, prefixes)
+                if changed is None:
+                    log_verbose('Unable to find out what was changed, planning everything')
+                elif not changed:
+                    log_verbose('Nothing was changed')
+                    return [], created_links
+                else:
+                    prefixes = changed
+                    partial_update = True
+
+        # create a files tree
+        if tree_builder is None:
+            tree_builder = partial(create_tree_from_filesystem,
+                                   jobs=_get_jobs(args),
+                                   tracked_only=args.get('--tracked-only', False))
+
+        while True:
+            with phases.phase('scan'):
+                if prefixes is None:
+                    tree = tree_builder(base_dir, envs)
+                else:
+                    tree = tree_builder(base_dir, envs, prefixes=prefixes)
+
+                if partial_update:
+                    tree = add_unscanned_envs(base_dir, tree, all_envs, envs, prefixes)
+
+            # next, generate actions to create necessary symlinks
+            with phases.phase('plan'):
+                if _get_shards(args) > 1:
+                    actions = create_install_actions_sharded(
+                        base_dir, home_dir, tree, _get_shards(args),
+                        plan_cache=plan_cache,
+                        created_links=created_links,
+                        **planning_options)
+                else:
+                    actions = create_install_actions(base_dir, home_dir, tree, fs,
+                                                     plan_cache=plan_cache,
+                                                     created_links=created_links,
+                                                     **planning_options)
+
+            replaced = _get_replaced_ancestors(actions, home_dir, prefixes or [])
+            if not replaced:
+                break
+            # symlinked directory will be replaced with real one,
+            # so everything inside of it should be linked again
+            prefixes = replaced + [prefix for prefix in prefixes
+                                   if not _is_under(tuple(prefix.split(os.sep)),
+                                                    [tuple(r.split(os.sep)) for r in replaced])]
+
+        # the last tree covers everything planned, including replaced dirs
+        phases.count('files', sum(map(_count_files, tree)))
+        phases.count('conflicts', sum(map(_count_conflicts, tree)))
+
+    if plan_cache is not None:
+        log_verbose('Plan cache: {0} hits, {1} misses'.format(
+            plan_cache.hits, plan_cache.misses))
+        plan_cache.save()
 
     # now, generate 'rm' actions for broken symlinks, among created
     # during previous 'dot update' invocation
-    created_links_filename = os.path.join(base_dir, '.created-links')
-    if os.path.exists(created_links_filename):
-        with open(created_links_filename) as f:
-            created_links = dict((line.strip().split(' -> '))
-                                 for line in f.readlines())
+    with phases.phase('broken-links'):
+        if partial_update:
+            remove_actions = create_actions_to_remove_broken_symlinks(
+                _filter_created_links(created_links, base_dir, home_dir,
+                                      envs, prefixes),
+                fs)
+        else:
             remove_actions = create_actions_to_remove_broken_symlinks(created_links, fs)
-    else:
-        created_links = {}
-        remove_actions = []
+    phases.count('broken-links-removed', len(remove_actions))
+
+    return remove_actions + actions, created_links
+
+
+def update(base_dir, home_dir, args,
+            processor=None,
+            tree_builder=None,
+            created_links=None,
+            served=False):
+    """Pulls envs, plans and applies actions.
+
+    The `created_links` could be given by a caller, which already
+    has them in memory, otherwise they are read from the base_dir.
+    Hooks of envs are run after the links were created.
+    Returns created links after the update.
+
+    Unless it is a dry run, a record of the run is appended to the
+    history, shown by `dot stats`. Runs of the daemon are marked as
+    `served` there.
+    With --metrics-file, metrics of the run are written to this file.
+    With --trace, timeline of the run is written to this file.
+    With --profile-memory, peak memory of each phase is reported and
+    the process exits with non zero code if some phase was over budget."""
+    dry_run = args['--dry']
+    fs = RealFS(relative_links=args.get('--relative', False))
+    profiler = None
+    tracer = None
+
+    with ExitStack() as stack:
+        recorder = stack.enter_context(HistoryRecorder())
+        stack.enter_context(phases.observe(recorder))
 
-    # next, generate actions to create necessary symlinks
-    actions = create_install_actions(base_dir, home_dir, tree, fs)
+        if args.get('--trace'):
+            tracer = stack.enter_context(TraceRecorder())
+            stack.enter_context(phases.observe(tracer))
 
-    if processor is None:
-        processor = processor_dry if dry_run else processor_real
+        if args.get('--profile-memory'):
+            profiler = stack.enter_context(MemoryProfiler())
+            stack.enter_context(phases.observe(profiler))
 
-    created_links = processor(remove_actions + actions, created_links, fs)
+        actions, created_links = create_update_actions(
+            base_dir, home_dir, args, fs,
+            tree_builder=tree_builder,
+            created_links=created_links)
 
+        for action_type, count in Counter(action[0] for action in actions).items():
+            phases.count('actions.' + action_type, count)
+
+        if processor is None:
+            processor = processor_dry if dry_run else processor_real
+
+        with phases.phase('apply'):
+            created_links = processor(actions, created_links, fs)
+
+        if not dry_run:
+            write_created_links(base_dir, home_dir, created_links)
+
+            with phases.phase('hooks'):
+                run_hooks(base_dir, home_dir,
+                          args.get('<env>') or _get_envs(base_dir),
+                          jobs=_get_jobs(args))
+
+    record = recorder.get_record(dry=dry_run, served=served)
     if not dry_run:
-        with open(created_links_filename, 'w') as f:
-            f.writelines('{0} -> {1}\n'.format(*item)
-                         for item in sorted(created_links.items()))
+        append_record(base_dir, record)
+
+    if args.get('--metrics-file'):
+        write_metrics(args['--metrics-file'], 'dot_update_',
+                      get_update_metrics(record, read_history(base_dir),
+                                         len(created_links)))
+
+    if tracer is not None:
+        tracer.write(args['--trace'])
+
+    if profiler is not None and profiler.report():
+        sys.exit(1)
+    return created_links
+
+
+def stats(base_dir, home_dir, args):
+    """Prints percentiles and trends of phase durations of updates."""
+    print('\n'.join(format_stats(read_history(base_dir))))
+
+
+def plan(base_dir, home_dir, args, tree_builder=None, created_links=None):
+    """Pulls envs and writes actions of the update into a plan file,
+    which could be applied later, probably on another machine."""
+    fs = RealFS(relative_links=args.get('--relative', False))
+    actions, created_links = create_update_actions(
+        base_dir, home_dir, args, fs,
+        tree_builder=tree_builder,
+        created_links=created_links)
+
+    write_plan(args['<plan-file>'], base_dir, home_dir, actions, fs,
+               relative=fs.relative_links)
+    log_verbose('Plan with {0} actions was written to {1}'.format(
+        len(actions), args['<plan-file>']))
+
+
+def apply(base_dir, home_dir, args):
+    """Applies actions from a plan file, without scanning envs.
+    Nothing is done if the home dir is not in the state it
+    was, when the plan was made."""
+    dry_run = args['--dry']
+    plan = read_plan(args['<plan-file>'])
+    fs = RealFS(relative_links=plan.get('relative', False))
+    # plan knows where links should point to
+    base_dir = plan['base_dir']
+    created_links = read_created_links(base_dir, plan['home_dir'])
+
+    problems = check_preconditions(plan, fs, created_links)
+    if problems:
+        for problem in problems:
+            log_error(problem)
+        log_error('Plan was not applied.')
+        return
+
+    processor = processor_dry if dry_run else processor_real
+    created_links = processor(plan['actions'], created_links, fs)
+
+    if not dry_run:
+        write_created_links(base_dir, plan['home_dir'], created_links)
+
+
+def _check_ignore_rules(base_dir):
+    """Returns descriptions of invalid regexes in .dotignore."""
+    ignored_files_config = os.path.join(base_dir, '.dotignore')
+    problems = []
+    if os.path.isfile(ignored_files_config):
+        with open(ignored_files_config) as f:
+            for number, line in enumerate(f, 1):
+                pattern = line.rstrip()
+                if pattern and not pattern.startswith('#'):
+                    try:
+                        re.compile(pattern)
+                    except re.error as e:
+                        problems.append('.dotignore:{0}: bad pattern "{1}": {2}'.format(
+                            number, pattern, e))
+    return problems
+
+
+def find_conflicts(base_dir, paths):
+    """Returns list of conflicts between envs for sorted full paths
+    of their files. Each conflict is a dict with path, envs and type,
+    which is 'file' when the same file exists in more than one env
+    and 'file-and-dir', when it is a file in one env and a directory
+    in another."""
+    files = defaultdict(list)
+    dirs = defaultdict(set)
+    base_dir_len = len(base_dir)
+
+    for path in paths:
+        env, relative = path[base_dir_len + 1:].split(os.sep, 1)
+        files[relative].append(env)
+        parts = relative.split(os.sep)
+        for i in range(1, len(parts)):
+            dirs[os.sep.join(parts[:i])].add(env)
+
+    conflicts = []
+    for relative in sorted(set(files) | set(dirs)):
+        file_envs = files.get(relative, [])
+        if len(file_envs) > 1:
+            conflicts.append(dict(path=relative, envs=sorted(file_envs), type='file'))
+        elif file_envs and relative in dirs:
+            conflicts.append(dict(path=relative,
+                                  envs=sorted(set(file_envs) | dirs[relative]),
+                                  type='file-and-dir'))
+    return conflicts
+
+
+def check(base_dir, home_dir, args):
+    """Checks envs for conflicts and .dotignore for errors without
+    pulling envs and without looking into the home dir. Exits with
+    non zero code if something is wrong."""
+    ignore_problems = _check_ignore_rules(base_dir)
+    conflicts = []
+
+    if not ignore_problems:
+        envs = args.get('<env>') or _get_envs(base_dir)
+        paths = scan_envs(base_dir, envs,
+                          jobs=_get_jobs(args),
+                          tracked_only=args.get('--tracked-only', False))
+        conflicts = find_conflicts(base_dir, paths)
+
+    if args.get('--json'):
+        print(json.dumps(dict(conflicts=conflicts,
+                              ignore_errors=ignore_problems),
+                         indent=2, sort_keys=True))
+    else:
+        for problem in ignore_problems:
+            log_error(problem)
+        for conflict in conflicts:
+            if conflict['type'] == 'file':
+                log_error('File {0} exists in more then one environments: {1}'.format(
+                    conflict['path'], ', '.join(conflict['envs'])))
+            else:
+                log_error('{0} is a file in one environment and a directory in another: {1}'.format(
+                    conflict['path'], ', '.join(conflict['envs'])))
+
+    if conflicts or ignore_problems:
+        sys.exit(1)
 
 
 def status(base_dir, home_dir, args):
+    """Prints envs with changes which were not committed or pushed.
+    With --metrics-file, state of each env is written to this file."""
     envs = _get_envs(base_dir)
+    states = {}
 
     cwd = os.getcwd()
 
@@ -461,16 +1734,27 @@ def status(base_dir, home_dir, args):
 
             if os.path.exists('.git'):
                 lines = []
+                state = states[env] = dict(versioned=True, has_upstream=True,
+                                           dirty=0, unpushed=0)
 
                 # check if it has remotes first, because if dont, than it is bad!
                 if not _current_env_has_remote_upstream():
                     lines.append('This repository has no remote upstream.')
+                    state['has_upstream'] = False
 
                 # next check repository's status
                 process = subprocess.Popen(['git', 'status', '--porcelain', '--branch'],
                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
                                            encoding='utf-8')
                 stdout = process.stdout.read()
+                for line in stdout.split('\n'):
+                    if line.startswith('##'):
+                        match = re.search(r'\[ahead (\d+)', line)
+                        if match:
+                            state['unpushed'] = int(match.group(1))
+                    elif line:
+                        state['dirty'] += 1
+
                 if stdout:
                     def replace_ahead(line):
                         if line.startswith('##'):
@@ -490,12 +1774,18 @@ def status(base_dir, home_dir, args):
                     print(env)
                     print('\n'.join('  ' + line for line in lines))
             else:
+                states[env] = dict(versioned=False, has_upstream=False,
+                                   dirty=0, unpushed=0)
                 print(env)
                 print('  Is not version controlled.')
 
     finally:
         os.chdir(cwd)
 
+    if args.get('--metrics-file'):
+        write_metrics(args['--metrics-file'], 'dot_status_',
+                      get_status_metrics(states))
+
 
 def _normalize_url(url):
     """Returns tuple (real_url, env_name), using
@@ -520,16 +1810,89 @@ def _normalize_url(url):
     return (url, name)
 
 
-def _add_url(url):
+def _read_copy_patterns(base_dir, envs):
+    """Returns dict env -> globs of files, which should be copied."""
+    copy_patterns = {}
+    for env in envs:
+        patterns = read_copy_patterns(os.path.join(base_dir, env))
+        if patterns:
+            copy_patterns[env] = patterns
+    return copy_patterns
+
+
+def _read_dependencies(env_path):
+    """Returns urls of envs, listed in the .dotdepends of the env."""
+    filename = os.path.join(env_path, DEPENDENCIES_FILENAME)
+    urls = []
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            for line in f:
+                url = line.strip()
+                if url and not url.startswith('#'):
+                    urls.append(url)
+    return urls
+
+
+def _get_dependencies(base_dir, env):
+    """Returns names of envs, listed in the manifest of the env."""
+    return [_normalize_url(url)[1]
+            for url in _read_dependencies(os.path.join(base_dir, env))]
+
+
+def _sort_by_dependencies(base_dir, envs):
+    """Returns envs ordered so, that each env goes after
+    envs it depends on. Dependencies between envs are
+    ignored if they form a cycle."""
+    envs_set = set(envs)
+    ordered = []
+    visited = set()
+
+    def visit(env):
+        if env in visited:
+            return
+        visited.add(env)
+        for dependency in _get_dependencies(base_dir, env):
+            if dependency in envs_set:
+                visit(dependency)
+        ordered.append(env)
+
+    for env in envs:
+        visit(env)
+    return ordered
+
+
+def _add_url(url, sparse=False, submodules=False, jobs=None, mirror_dir=None):
     """Installs repo from given url at current dir.
+
+    If sparse is True, files ignored by .dotignore aren't
+    written to the disk. If submodules is True, they are
+    fetched in parallel. If mirror_dir is given, repo borrows
+    objects from the shared mirror in this directory.
     """
     url, env = _normalize_url(url)
 
+    reference = []
+    if mirror_dir and not os.path.exists(env):
+        mirror = _refresh_mirror(mirror_dir, url)
+        if mirror is not None:
+            reference = ['--reference', mirror]
+
     if os.path.exists(env):
         log_error('Environment "{0}" already exists.'.format(env))
+    elif sparse:
+        log_verbose('Cloning repository "{0} to "{1}" dir without ignored files.'.format(url, env))
+        subprocess.check_call(['git', 'clone', '--no-checkout'] + reference + [url, env])
+        # current dir is a base dir
+        patterns = _get_sparse_patterns(env, _read_ignored_files(os.curdir))
+        if patterns is not None:
+            _set_sparse_checkout(env, patterns)
+        subprocess.check_call(['git', 'checkout', '--quiet'], cwd=env)
     else:
         log_verbose('Cloning repository "{0} to "{1}" dir.'.format(url, env))
-        process = subprocess.check_call(['git', 'clone', url, env])
+        process = subprocess.check_call(['git', 'clone'] + reference + [url, env])
+
+    if submodules and os.path.isdir(env):
+        sync_submodules(os.curdir, env, jobs=jobs)
 
 
 def add(base_dir, home_dir, args):
@@ -538,13 +1901,47 @@ def add(base_dir, home_dir, args):
     original_cwd = os.getcwd()
     os.chdir(base_dir)
 
+    # envs are added level by level: given ones first, then their
+    # dependencies, then dependencies of dependencies and so on
+    seen = set()
+    level = urls
     try:
-        for url in urls:
-            _add_url(url)
+        while level:
+            new_urls = []
+            envs = []
+            for url in level:
+                env = _normalize_url(url)[1]
+                if env in seen:
+                    continue
+                seen.add(env)
+                envs.append(env)
+
+                if level is urls or not os.path.exists(env):
+                    new_urls.append(url)
+                else:
+                    log_verbose('Dependency "{0}" already exists.'.format(env))
+
+            with ThreadPoolExecutor(max_workers=_get_jobs(args)) as executor:
+                futures = [executor.submit(_add_url, url,
+                                           sparse=args.get('--sparse', False),
+                                           submodules=args.get('--submodules', False),
+                                           jobs=_get_jobs(args),
+                                           mirror_dir=_get_mirror_dir(args))
+                           for url in new_urls]
+                for future in futures:
+                    future.result()
+
+            level = [dependency
+                     for env in envs
+                     for dependency in _read_dependencies(env)]
     finally:
         os.chdir(original_cwd)
 
 
 COMMANDS = dict(update=update,
+                plan=plan,
+                apply=apply,
+                check=check,
                 status=status,
+                stats=stats,
                 add=add)
@@ -0,0 +1,192 @@
+# coding: utf-8
+"""History of updates.
+
+Each update appends a record to the .update-history file of the base
+dir, one JSON object per line. A record holds the time of the run,
+durations of phases in seconds and numbers reported with
+`phases.count()`, like scanned files, planned actions of each type and
+bytes of state files read and written. `dot stats` shows percentiles
+and daily trends of these numbers.
+
+Dry runs are not recorded. Runs served by the daemon are tagged, and
+are left out of stats, because a warm cache makes them incomparable
+with other runs.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from collections import defaultdict
+
+
+HISTORY_FILENAME = '.update-history'
+# when history grows bigger, only the newer half of it is kept
+MAX_HISTORY_SIZE = 1024 * 1024
+
+
+class _ErrorCounter(logging.Handler):
+    def __init__(self):
+        super(_ErrorCounter, self).__init__(logging.ERROR)
+        self.errors = 0
+
+    def emit(self, record):
+        self.errors += 1
+
+
+class HistoryRecorder(object):
+    """Phases observer, which collects a record of the run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = {}
+        self._counter = _ErrorCounter()
+        self.timestamp = None
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def __enter__(self):
+        self.timestamp = time.time()
+        self._run_started = time.monotonic()
+        logging.getLogger().addHandler(self._counter)
+        return self
+
+    def __exit__(self, *args):
+        logging.getLogger().removeHandler(self._counter)
+        self.durations['total'] = time.monotonic() - self._run_started
+
+    def start(self, name, detail=None):
+        if detail is not None:
+            return
+        # the same phase could run in several threads of pipelined update
+        with self._lock:
+            self._started[(threading.get_ident(), name)] = time.monotonic()
+
+    def finish(self, name, detail=None):
+        if detail is not None:
+            return
+        with self._lock:
+            started = self._started.pop((threading.get_ident(), name))
+            self.durations[name] += time.monotonic() - started
+
+    def count(self, name, value):
+        with self._lock:
+            self.counts[name] += value
+
+    def get_record(self, **extra):
+        return dict(extra,
+                    timestamp=round(self.timestamp, 3),
+                    durations=dict((name, round(duration, 4))
+                                   for name, duration in self.durations.items()),
+                    counts=dict(self.counts),
+                    errors=self._counter.errors)
+
+
+def append_record(base_dir, record):
+    filename = os.path.join(base_dir, HISTORY_FILENAME)
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    if os.path.getsize(filename) > MAX_HISTORY_SIZE:
+        records = read_history(base_dir)
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            f.writelines(json.dumps(kept, sort_keys=True) + '\n'
+                         for kept in records[len(records) // 2:])
+        os.rename(temp_filename, filename)
+
+
+def read_history(base_dir):
+    """Returns records of the history, older first."""
+    filename = os.path.join(base_dir, HISTORY_FILENAME)
+    records = []
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # last line could be cut by an interrupted run
+                    pass
+    return records
+
+
+def percentile(values, p):
+    """Returns p-th percentile of values, using nearest rank."""
+    values = sorted(values)
+    index = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+    return values[index]
+
+
+def _get_phases(records):
+    names = set()
+    for record in records:
+        names.update(record['durations'])
+    names.discard('total')
+    return ['total'] + sorted(names)
+
+
+def format_stats(records):
+    """Returns lines of the report with percentiles of phase durations
+    and with their daily medians, to see when a phase became slower."""
+    served = sum(1 for record in records if record.get('served'))
+    # dry runs were recorded by older versions
+    records = [record for record in records
+               if not record.get('served') and not record.get('dry')]
+    if not records:
+        return ['History of updates is empty.']
+
+    def format_time(timestamp, format='%Y-%m-%d %H:%M'):
+        return time.strftime(format, time.localtime(timestamp))
+
+    lines = ['{0} runs from {1} to {2}, {3} with errors.'.format(
+        len(records),
+        format_time(records[0]['timestamp']),
+        format_time(records[-1]['timestamp']),
+        sum(1 for record in records if record.get('errors')))]
+    if served:
+        lines.append('Runs served by the daemon are not included: {0}.'.format(served))
+
+    names = _get_phases(records)
+    lines.append('')
+    lines.append('{0:<14}{1:>6}{2:>9}{3:>9}{4:>9}{5:>9}'.format(
+        'phase', 'runs', 'p50', 'p90', 'p99', 'max'))
+    for name in names:
+        durations = [record['durations'][name]
+                     for record in records
+                     if name in record['durations']]
+        if durations:
+            lines.append('{0:<14}{1:>6}{2:>9.2f}{3:>9.2f}{4:>9.2f}{5:>9.2f}'.format(
+                name, len(durations),
+                percentile(durations, 50),
+                percentile(durations, 90),
+                percentile(durations, 99),
+                max(durations)))
+
+    files = [record['counts'].get('files', 0) for record in records]
+    lines.append('')
+    lines.append('Scanned files: p50 {0}, max {1}.'.format(
+        percentile(files, 50), max(files)))
+
+    days = defaultdict(list)
+    for record in records:
+        days[format_time(record['timestamp'], '%Y-%m-%d')].append(record)
+
+    lines.append('')
+    lines.append('Median durations by day:')
+    lines.append('{0:<12}{1:>6}'.format('day', 'runs')
+                 + ''.join('{0:>10}'.format(name[:9]) for name in names))
+    for day, day_records in sorted(days.items()):
+        cells = []
+        for name in names:
+            durations = [record['durations'][name]
+                         for record in day_records
+                         if name in record['durations']]
+            cells.append('{0:>10.2f}'.format(percentile(durations, 50))
+                         if durations else '{0:>10}'.format('-'))
+        lines.append('{0:<12}{1:>6}'.format(day, len(day_records)) + ''.join(cells))
+    return lines
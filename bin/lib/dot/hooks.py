@@ -0,0 +1,153 @@
+# coding: utf-8
+"""Hooks, which are run after the update.
+
+Each env could have a .dothooks file, where each line is a hook:
+
+    .zshrc .zsh/**/*.zsh: zsh -c 'zcompile .zshrc'
+
+Before the colon are globs of hook's inputs, relative to the env's
+root, after it is a shell command, which is run in the env's root.
+A hook is run only if its inputs were changed since its last
+successful run. Hashes of inputs are kept in .hooks-state of the
+base dir.
+"""
+from __future__ import absolute_import
+
+import glob
+import hashlib
+import json
+import os
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+from . import phases
+from .logging import log_verbose, log_error
+
+
+HOOKS_FILENAME = '.dothooks'
+HOOKS_STATE_FILENAME = '.hooks-state'
+
+
+def read_hooks(env_path):
+    """Returns list of (line, globs, command) from .dothooks of the env."""
+    filename = os.path.join(env_path, HOOKS_FILENAME)
+    hooks = []
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    if ':' not in line:
+                        log_error('Bad hook in {0}, it should be "<globs>: <command>": {1}'.format(
+                            filename, line))
+                        continue
+                    globs, command = line.split(':', 1)
+                    hooks.append((line, globs.split(), command.strip()))
+    return hooks
+
+
+def hash_inputs(env_path, globs):
+    """Returns hash of names and contents of all files
+    matching globs inside of the env."""
+    paths = set()
+    for pattern in globs:
+        paths.update(path
+                     for path in glob.glob(os.path.join(env_path, pattern),
+                                           recursive=True)
+                     if os.path.isfile(path))
+
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        digest.update(os.path.relpath(path, env_path).encode('utf-8', 'surrogateescape'))
+        digest.update(b'\0')
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _read_state(base_dir):
+    filename = os.path.join(base_dir, HOOKS_STATE_FILENAME)
+    if os.path.exists(filename):
+        phases.count('state-read', os.path.getsize(filename))
+        with open(filename) as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                pass
+    return {}
+
+
+def _write_state(base_dir, state):
+    filename = os.path.join(base_dir, HOOKS_STATE_FILENAME)
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    phases.count('state-written', os.path.getsize(temp_filename))
+    os.rename(temp_filename, filename)
+
+
+def _run_hook(base_dir, home_dir, env, command):
+    """Runs the command and returns True if it succeeded."""
+    env_vars = dict(os.environ,
+                    DOT_BASE_DIR=base_dir,
+                    DOT_HOME_DIR=home_dir,
+                    DOT_ENV=env)
+    with phases.phase('hooks', env):
+        process = subprocess.Popen(command, shell=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   encoding='utf-8', errors='replace',
+                                   cwd=os.path.join(base_dir, env), env=env_vars)
+        lines = [' ' * 4 + line.rstrip() for line in process.stdout]
+        returncode = process.wait()
+    # output is logged at once, to not mix it with other hooks
+    log_verbose('\n'.join(['Running hook of "{0}": {1}'.format(env, command)] + lines))
+
+    if returncode != 0:
+        log_error('Hook of "{0}" failed with code {1}: {2}'.format(
+            env, returncode, command))
+        return False
+    return True
+
+
+def run_hooks(base_dir, home_dir, envs, jobs=None):
+    """Runs hooks of envs, whose inputs were changed, on a thread
+    pool of `jobs` workers. Returns number of failed hooks."""
+    state = _read_state(base_dir)
+    previous_state = json.dumps(state, sort_keys=True)
+    to_run = []
+
+    for env in envs:
+        env_path = os.path.join(base_dir, env)
+        env_state = state.get(env, {})
+        hooks = read_hooks(env_path)
+
+        # forget hooks which were removed from .dothooks
+        state[env] = dict((line, env_state[line])
+                          for line, globs, command in hooks
+                          if line in env_state)
+        for line, globs, command in hooks:
+            if env_state.get(line) == hash_inputs(env_path, globs):
+                log_verbose('Inputs of hook of "{0}" were not changed: {1}'.format(
+                    env, command))
+            else:
+                to_run.append((env, line, globs, command))
+
+    failed = 0
+    if to_run:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [(executor.submit(_run_hook, base_dir, home_dir, env, command),
+                        env, line, globs)
+                       for env, line, globs, command in to_run]
+            for future, env, line, globs in futures:
+                if future.result():
+                    # hook could change its own inputs
+                    state[env][line] = hash_inputs(os.path.join(base_dir, env), globs)
+                else:
+                    failed += 1
+
+    state = dict((env, hooks) for env, hooks in state.items() if hooks)
+    if json.dumps(state, sort_keys=True) != previous_state:
+        _write_state(base_dir, state)
+    return failed
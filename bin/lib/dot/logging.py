@@ -48,5 +48,8 @@ log_link = _create_logger(LINK, 'magenta')
 log_mkdir = _create_logger(MKDIR, 'magenta')
 log_rm = _create_logger(RM, 'magenta')
 
+# warnings are yellow
+log_warning = _create_logger(logging.WARNING, 'yellow')
+
 # errors are red
 log_error = _create_logger(logging.ERROR, 'red')
@@ -0,0 +1,100 @@
+# coding: utf-8
+"""Memory profiling of phases with tracemalloc.
+
+For each outermost phase, profiler remembers peak of traced memory
+and allocation sites which grew the most during the phase. Peaks are
+compared with a budget, proportional to the number of scanned files.
+"""
+from __future__ import absolute_import
+
+import tracemalloc
+
+from .logging import log_verbose, log_error
+
+
+# peak of any phase should not be more than this, per 10000 files
+BUDGET_PER_10K_FILES = 64 * 1024 * 1024
+
+TOP_SITES = 5
+
+
+class MemoryProfiler(object):
+    def __init__(self, top_sites=TOP_SITES):
+        self._top_sites = top_sites
+        self._depth = 0
+        self._snapshot = None
+        self.files = 0
+        # list of (phase, peak in bytes, [(site, size diff in bytes)])
+        self.phases = []
+
+    def __enter__(self):
+        tracemalloc.start()
+        return self
+
+    def __exit__(self, *args):
+        tracemalloc.stop()
+
+    def start(self, name, detail=None):
+        if detail is not None:
+            return
+        # nested phases are a part of the outer one
+        self._depth += 1
+        if self._depth == 1:
+            self._snapshot = _take_snapshot()
+            tracemalloc.reset_peak()
+
+    def finish(self, name, detail=None):
+        if detail is not None:
+            return
+        self._depth -= 1
+        if self._depth == 0:
+            peak = tracemalloc.get_traced_memory()[1]
+            snapshot = _take_snapshot()
+            stats = snapshot.compare_to(self._snapshot, 'lineno')
+            sites = [(str(stat.traceback[0]), stat.size_diff)
+                     for stat in stats[:self._top_sites]
+                     if stat.size_diff > 0]
+            self._snapshot = None
+            self.phases.append((name, peak, sites))
+
+    def count(self, name, value):
+        if name == 'files':
+            self.files += value
+
+    def get_budget(self):
+        return BUDGET_PER_10K_FILES * max(self.files, 1) / 10000.0
+
+    def check_budget(self):
+        """Returns list of problems, empty if all phases fit the budget."""
+        budget = self.get_budget()
+        return ['Phase "{0}" allocated {1} at peak, which is more than {2} budget for {3} files.'.format(
+                    name, _format_size(peak), _format_size(budget), self.files)
+                for name, peak, sites in self.phases
+                if peak > budget]
+
+    def report(self):
+        """Logs peaks of phases and returns problems with the budget."""
+        for name, peak, sites in self.phases:
+            log_verbose('Memory of phase "{0}": {1} at peak'.format(
+                name, _format_size(peak)))
+            for site, size in sites:
+                log_verbose('    {0}: +{1}'.format(site, _format_size(size)))
+
+        problems = self.check_budget()
+        for problem in problems:
+            log_error(problem)
+        return problems
+
+
+def _take_snapshot():
+    # allocations of the profiler itself are not interesting
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def _format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f} GiB'.format(size)
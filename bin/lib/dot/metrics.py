@@ -0,0 +1,129 @@
+# coding: utf-8
+"""Metrics in the textfile format of Prometheus node_exporter.
+
+`update` and `status` could write their metrics into the same file.
+Each command replaces only metrics with its own prefix and keeps
+others. The file is replaced atomically, so the collector never reads
+a half written file.
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import tempfile
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def _get_name(line):
+    """Returns name of the metric, described or sampled on the line."""
+    if line.startswith('#'):
+        parts = line.split()
+        return parts[2] if len(parts) > 2 else None
+    match = re.match(r'[a-zA-Z_:][a-zA-Z0-9_:]*', line)
+    return match.group(0) if match else None
+
+
+def format_metrics(metrics):
+    """Metrics are given as list of tuples (name, type, help, samples),
+    where samples is a list of (labels, value) and labels is a dict."""
+    lines = []
+    for name, type, help, samples in metrics:
+        lines.append('# HELP {0} {1}'.format(name, help))
+        lines.append('# TYPE {0} {1}'.format(name, type))
+        for labels, value in samples:
+            if labels:
+                name_with_labels = '{0}{{{1}}}'.format(name, ','.join(
+                    '{0}="{1}"'.format(key, _escape(labels[key]))
+                    for key in sorted(labels)))
+            else:
+                name_with_labels = name
+            lines.append('{0} {1}'.format(name_with_labels, value))
+    return lines
+
+
+def write_metrics(filename, prefix, metrics):
+    """Replaces metrics starting with prefix in the file."""
+    lines = []
+    if os.path.exists(filename):
+        with open(filename) as f:
+            lines = [line.rstrip('\n') for line in f
+                     if not (_get_name(line) or '').startswith(prefix)]
+
+    lines.extend(format_metrics(metrics))
+
+    # temporary file is created in the same dir, to be renamed atomically
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(prefix='.dot-metrics-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        os.chmod(temp_filename, 0o644)
+        os.replace(temp_filename, filename)
+    except Exception:
+        os.unlink(temp_filename)
+        raise
+
+
+def get_update_metrics(record, history, managed_links):
+    """Returns metrics of the update from its history record. Time of
+    the last successful run is taken from the history of updates."""
+    counts = record['counts']
+    successes = [previous['timestamp'] for previous in history
+                 if not previous.get('dry') and not previous.get('errors')]
+    metrics = [
+        ('dot_update_phase_duration_seconds', 'gauge',
+         'Duration of the phase during the last update.',
+         [(dict(phase=name), duration)
+          for name, duration in sorted(record['durations'].items())]),
+        ('dot_update_files_scanned', 'gauge',
+         'Number of files found in envs during the last update.',
+         [({}, counts.get('files', 0))]),
+        ('dot_update_managed_links', 'gauge',
+         'Number of links and copies created by dot in the home dir.',
+         [({}, managed_links)]),
+        ('dot_update_broken_links_removed', 'gauge',
+         'Number of broken links planned to be removed by the last update.',
+         [({}, counts.get('broken-links-removed', 0))]),
+        ('dot_update_conflicts', 'gauge',
+         'Number of files which exist in more than one env.',
+         [({}, counts.get('conflicts', 0))]),
+        ('dot_update_errors', 'gauge',
+         'Number of errors during the last update.',
+         [({}, record['errors'])]),
+        ('dot_update_last_run_timestamp_seconds', 'gauge',
+         'Time of the last update.',
+         [({}, record['timestamp'])]),
+    ]
+    if successes:
+        metrics.append(('dot_update_last_success_timestamp_seconds', 'gauge',
+                        'Time of the last update without errors.',
+                        [({}, successes[-1])]))
+    return metrics
+
+
+def get_status_metrics(envs):
+    """Returns metrics of status. Envs are given as a dict of
+    env -> dict(versioned, has_upstream, dirty, unpushed)."""
+    def samples(key):
+        return [(dict(env=env), int(state[key]))
+                for env, state in sorted(envs.items())]
+
+    return [
+        ('dot_status_env_versioned', 'gauge',
+         'Whether the env is a git repository.',
+         samples('versioned')),
+        ('dot_status_env_has_upstream', 'gauge',
+         'Whether the env has a remote upstream.',
+         samples('has_upstream')),
+        ('dot_status_env_dirty_files', 'gauge',
+         'Number of changed or untracked files in the env.',
+         samples('dirty')),
+        ('dot_status_env_unpushed_commits', 'gauge',
+         'Number of commits of the env, which were not pushed.',
+         samples('unpushed')),
+    ]
@@ -0,0 +1,123 @@
+# coding: utf-8
+"""Shared mirrors of env repositories.
+
+When many users or containers on one host clone the same envs, they
+could share a directory with bare mirrors of these repositories.
+Envs are cloned with `--reference` to a mirror, so their objects are
+taken from it instead of the network and are not duplicated on disk.
+Each mirror is fetched at most once in MIRROR_MAX_AGE seconds, no
+matter how many users pull envs cloned from it.
+
+Envs borrow objects from mirrors, so mirrors are never garbage
+collected automatically. Mirrors, their lock and stamp files are
+writable by the group, so users sharing them should be in one group.
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import subprocess
+import time
+
+from contextlib import contextmanager
+from .logging import log_verbose
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+MIRROR_MAX_AGE = 5 * 60
+# touched after each successful fetch of the mirror
+STAMP_FILENAME = 'dot-fetched'
+# files and dirs are created writable by the group regardless of umask
+SHARED_FILE_MODE = 0o664
+SHARED_DIR_MODE = 0o2775
+
+
+def get_mirror_path(mirror_dir, url):
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', re.sub(r'^[a-z+]+://', '', url))
+    if not name.endswith('.git'):
+        name += '.git'
+    return os.path.join(mirror_dir, name)
+
+
+def _open_shared(path):
+    """Opens file for writing. If file is created, it is made
+    writable by the group, so other users could lock and touch it."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, SHARED_FILE_MODE)
+    except FileExistsError:
+        return open(path, 'w')
+    os.chmod(path, SHARED_FILE_MODE)
+    return os.fdopen(fd, 'w')
+
+
+@contextmanager
+def _locked(path):
+    """Doesn't let other processes update the same mirror."""
+    with _open_shared(path + '.lock') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _is_fresh(path, max_age):
+    try:
+        mtime = os.stat(os.path.join(path, STAMP_FILENAME)).st_mtime
+    except OSError:
+        return False
+    return time.time() - mtime < max_age
+
+
+def _touch(path):
+    with _open_shared(os.path.join(path, STAMP_FILENAME)):
+        pass
+
+
+def borrows_from(repo_path, mirror_path):
+    """Checks if the repo was cloned with --reference to the mirror,
+    that is, its alternates point to objects of the mirror."""
+    repo_objects = os.path.join(repo_path, '.git', 'objects')
+    alternates = os.path.join(repo_objects, 'info', 'alternates')
+    if not os.path.isfile(alternates):
+        return False
+
+    mirror_objects = os.path.realpath(os.path.join(mirror_path, 'objects'))
+    with open(alternates) as f:
+        # relative paths are relative to the objects dir
+        return any(os.path.realpath(os.path.join(repo_objects, line.strip())) == mirror_objects
+                   for line in f
+                   if line.strip() and not line.startswith('#'))
+
+
+def refresh_mirror(mirror_dir, url, max_age=MIRROR_MAX_AGE):
+    """Creates a mirror of the url or fetches it, if it wasn't
+    fetched recently. Returns path to the mirror.
+
+    Raises CalledProcessError if git fails and OSError if
+    the mirror_dir is not writable."""
+    if not os.path.isdir(mirror_dir):
+        os.makedirs(mirror_dir)
+        os.chmod(mirror_dir, SHARED_DIR_MODE)
+
+    path = get_mirror_path(mirror_dir, url)
+    with _locked(path):
+        if not os.path.isdir(path):
+            log_verbose('Creating mirror of "{0}" in "{1}".'.format(url, path))
+            subprocess.check_call(['git', 'clone', '--quiet', '--mirror',
+                                   # other users should be able to update it
+                                   '--config', 'core.sharedRepository=group',
+                                   '--config', 'gc.auto=0',
+                                   url, path])
+            _touch(path)
+        elif not _is_fresh(path, max_age):
+            log_verbose('Fetching mirror of "{0}".'.format(url))
+            subprocess.check_call(['git', '-C', path, 'fetch', '--quiet', '--prune'])
+            _touch(path)
+    return path
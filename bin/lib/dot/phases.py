@@ -0,0 +1,51 @@
+# coding: utf-8
+"""Phases of commands, like pull, scan, plan and apply.
+
+Code marks its phases with `phase()` and reports numbers, like count
+of scanned files, with `count()`. Observers, added with `observe()`,
+are notified about each of these events. Without observers, marking
+phases costs almost nothing.
+
+Smaller spans inside of phases, like a pull of one env or planning
+of one top level item, are marked with `phase(name, detail)`.
+Observers which are interested only in whole phases ignore spans
+with a detail.
+"""
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+
+
+_observers = []
+
+
+@contextmanager
+def observe(observer):
+    """Notifies the observer about phases while inside of the block.
+
+    Observer should have methods `start(name, detail=None)`,
+    `finish(name, detail=None)` and `count(name, value)`. Phases
+    could be nested and, in pipelined updates, could run in
+    parallel threads.
+    """
+    _observers.append(observer)
+    try:
+        yield observer
+    finally:
+        _observers.remove(observer)
+
+
+@contextmanager
+def phase(name, detail=None):
+    for observer in _observers:
+        observer.start(name, detail)
+    try:
+        yield
+    finally:
+        for observer in reversed(_observers):
+            observer.finish(name, detail)
+
+
+def count(name, value):
+    for observer in _observers:
+        observer.count(name, value)
@@ -0,0 +1,160 @@
+# coding: utf-8
+"""Cache of planned actions for top level items of the tree.
+
+Each top level item is identified by a Merkle hash of its subtree.
+Together with actions, cache keeps a fingerprint of all home paths,
+which were looked at while these actions were planned. If the hash
+of an item and the fingerprint of its paths are the same on the next
+run, actions are taken from the cache instead of planning them again.
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import threading
+
+from . import phases
+
+
+class RecordingFS(object):
+    """Wraps a filesystem and remembers all paths it was asked about."""
+
+    def __init__(self, fs):
+        self._fs = fs
+        self.paths = set()
+
+    def __getattr__(self, name):
+        return getattr(self._fs, name)
+
+    def exists(self, path):
+        self.paths.add(path)
+        return self._fs.exists(path)
+
+    def is_symlink(self, path):
+        self.paths.add(path)
+        return self._fs.is_symlink(path)
+
+    def get_symlink_target(self, path):
+        self.paths.add(path)
+        return self._fs.get_symlink_target(path)
+
+    def get_file_info(self, path):
+        self.paths.add(path)
+        return self._fs.get_file_info(path)
+
+    def hash_file(self, path):
+        self.paths.add(path)
+        return self._fs.hash_file(path)
+
+    def realpath(self, path):
+        # result depends on every component of the path
+        component = path
+        while component and component != os.path.dirname(component):
+            self.paths.add(component)
+            component = os.path.dirname(component)
+        return self._fs.realpath(path)
+
+
+def tree_hash(item):
+    """Returns Merkle hash of the tree item, which changes when
+    any file inside of it is added, removed or moved to other env."""
+    digest = hashlib.sha1()
+    digest.update(item.name.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update('|'.join(item.envs).encode('utf-8'))
+
+    for child in getattr(item, 'children', []):
+        digest.update(b'\0')
+        digest.update(tree_hash(child).encode('ascii'))
+    return digest.hexdigest()
+
+
+class PlanCache(object):
+    VERSION = 1
+
+    def __init__(self, filename, base_dir, home_dir, fs, options=None):
+        """Options, like relative links or patterns of copied files,
+        change how items are planned, so if they are not the same,
+        the cache is not used."""
+        self.filename = filename
+        self._base_dir = base_dir
+        self._home_dir = home_dir
+        self._options = options or {}
+        self._fs = fs
+        self._entries = {}
+        self._new_entries = {}
+        # pipelined update plans items in several threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.exists(filename):
+            with open(filename) as f:
+                try:
+                    data = json.load(f)
+                except ValueError:
+                    data = {}
+            phases.count('state-read', os.path.getsize(filename))
+
+            if (data.get('version') == self.VERSION
+                    and data.get('base_dir') == base_dir
+                    and data.get('home_dir') == home_dir
+                    and data.get('options', {}) == self._options):
+                self._entries = data['entries']
+
+    def recording(self, fs):
+        return RecordingFS(fs)
+
+    def key(self, item):
+        return tree_hash(item)
+
+    def _fingerprint(self, paths):
+        digest = hashlib.sha1()
+        for path in sorted(paths):
+            digest.update(path.encode('utf-8', 'surrogateescape'))
+            digest.update(repr(self._fs.fingerprint(path)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns cached actions or None if there are no
+        actions for this key or home was changed."""
+        entry = self._entries.get(key)
+        if entry is not None and self._fingerprint(entry['paths']) == entry['fingerprint']:
+            with self._lock:
+                self.hits += 1
+                self._new_entries[key] = entry
+            return [tuple(action) for action in entry['actions']]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, name, actions, paths):
+        paths = sorted(paths)
+        entry = dict(name=name,
+                     actions=actions,
+                     paths=paths,
+                     fingerprint=self._fingerprint(paths))
+        with self._lock:
+            self._new_entries[key] = entry
+
+    def save(self):
+        # entries for items which were planned during this run replace
+        # all previous entries for items with the same name
+        names = set(entry['name'] for entry in self._new_entries.values())
+        entries = dict((key, entry)
+                       for key, entry in self._entries.items()
+                       if entry['name'] not in names)
+        entries.update(self._new_entries)
+
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(dict(version=self.VERSION,
+                           base_dir=self._base_dir,
+                           home_dir=self._home_dir,
+                           options=self._options,
+                           entries=entries),
+                      f)
+        phases.count('state-written', os.path.getsize(temp_filename))
+        os.rename(temp_filename, self.filename)
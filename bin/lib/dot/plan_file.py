@@ -0,0 +1,96 @@
+# coding: utf-8
+"""Plan files, made by 'dot plan' and executed by 'dot apply'.
+
+A plan file is a JSON document with actions of the update and
+with the state of each path these actions touch, as it was when
+the plan was made. Before applying the plan, these states are
+compared with the actual ones, which costs one lstat per path
+instead of scanning all envs again.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+
+from .copies import CopiedFile
+
+
+VERSION = 1
+
+
+def _get_path(action):
+    """Returns the path in the home dir which is affected by the action."""
+    if action[0] in ('rm', 'mkdir'):
+        return action[1]
+    if action[0] in ('link', 'already-linked', 'copy', 'already-copied'):
+        return action[2]
+    return None
+
+
+def get_preconditions(actions, fs):
+    """Returns list of [path, state] for each path, touched by actions,
+    in the order of actions."""
+    seen = set()
+    preconditions = []
+    for action in actions:
+        path = _get_path(action)
+        if path is not None and path not in seen:
+            seen.add(path)
+            preconditions.append([path, fs.get_state(path)])
+    return preconditions
+
+
+def write_plan(filename, base_dir, home_dir, actions, fs, relative=False):
+    data = dict(version=VERSION,
+                base_dir=base_dir,
+                home_dir=home_dir,
+                relative=relative,
+                actions=actions,
+                preconditions=get_preconditions(actions, fs))
+
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.rename(temp_filename, filename)
+
+
+def read_plan(filename):
+    with open(filename) as f:
+        data = json.load(f)
+
+    if data.get('version') != VERSION:
+        raise RuntimeError('Unsupported plan version: {0}'.format(
+            data.get('version')))
+
+    data['actions'] = [tuple(action) for action in data['actions']]
+    return data
+
+
+def check_preconditions(plan, fs, created_links=None):
+    """Returns list of problems, empty if the plan could be applied.
+
+    If created_links are given, files which the plan expects to be
+    up to date copies should be known there as copies, otherwise
+    the plan was probably made on another machine."""
+    problems = []
+    for path, expected in plan['preconditions']:
+        actual = fs.get_state(path)
+        if actual != expected:
+            problems.append('{0} was expected to be {1}, but it is {2}.'.format(
+                path, _describe(expected), _describe(actual)))
+
+    if created_links is not None:
+        for action in plan['actions']:
+            if (action[0] == 'already-copied'
+                    and not isinstance(created_links.get(action[2]), CopiedFile)):
+                problems.append('{0} was expected to be a copy of {1}, but it was not copied by dot.'.format(
+                    action[2], action[1]))
+    return problems
+
+
+def _describe(state):
+    if state is None:
+        return 'missing'
+    if isinstance(state, list):
+        return 'a symlink to {0}'.format(state[1])
+    return 'a ' + state
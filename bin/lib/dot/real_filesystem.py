@@ -1,7 +1,17 @@
+import hashlib
 import os.path
+import shutil
 
 
 class RealFS(object):
+    # directories could be listed by SnapshotFS
+    can_scandir = True
+
+    def __init__(self, relative_links=False):
+        # if True, symlinks are created with paths
+        # relative to their directories
+        self.relative_links = relative_links
+
     def exists(self, path):
         return os.path.lexists(path)
 
@@ -14,6 +24,69 @@ class RealFS(object):
     def realpath(self, path):
         return os.path.realpath(path)
 
+    def get_state(self, path):
+        """Returns None if path doesn't exist, ['link', target] for
+        symlinks, 'dir' for directories and 'file' for anything else."""
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            return None
+        if os.path.stat.S_ISLNK(stat.st_mode):
+            return ['link', os.readlink(path)]
+        if os.path.stat.S_ISDIR(stat.st_mode):
+            return 'dir'
+        return 'file'
+
+    def fingerprint(self, path):
+        """Returns something what changes when the path is
+        created, removed, replaced or symlink is changed."""
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            return None
+        if os.path.stat.S_ISLNK(stat.st_mode):
+            return (stat.st_mode, stat.st_ino, stat.st_ctime_ns)
+        if os.path.stat.S_ISREG(stat.st_mode):
+            # content matters for copies
+            return (stat.st_mode, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        # directory's mtime changes on any file inside it,
+        # but we only care if it was replaced
+        return (stat.st_mode, stat.st_ino)
+
+    def get_file_info(self, path):
+        """Returns (size, mtime) of the file or None if it doesn't exist."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def hash_file(self, path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def copy(self, source, target):
+        """Copies source to target atomically, so target is never
+        half written. Returns sha1 of the content."""
+        digest = hashlib.sha1()
+        temp_filename = os.path.join(os.path.dirname(target),
+                                     '.' + os.path.basename(target) + '.dot-tmp')
+        try:
+            with open(source, 'rb') as src, open(temp_filename, 'wb') as dst:
+                for chunk in iter(lambda: src.read(65536), b''):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            shutil.copymode(source, temp_filename)
+            os.replace(temp_filename, target)
+        except:
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+            raise
+        return digest.hexdigest()
+
     def rm(self, path):
         os.unlink(path)
 
@@ -21,8 +94,9 @@ class RealFS(object):
         os.mkdir(path)
 
     def symlink(self, source, link_name):
+        if self.relative_links:
+            source = os.path.relpath(source, os.path.dirname(link_name))
         try:
-            import os
             os_symlink = getattr(os, "symlink", None)
             if callable(os_symlink):
                 os_symlink(source, link_name)
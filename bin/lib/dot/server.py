@@ -0,0 +1,245 @@
+# coding: utf-8
+"""Persistent 'dot serve' daemon.
+
+Daemon keeps the env tree and created links in memory and answers
+'update', 'plan' and 'status' requests on a unix socket. Paths in
+arguments should be absolute, because the daemon has its own CWD. Requests
+and responses are JSON objects, one per line. Daemon streams log
+records and stdout of the command to the client and finishes
+response with {"done": true}. The client is in the client module.
+
+Daemon creates links and writes files with privileges of its owner,
+so the socket is accessible only by the owner and requests of other
+users are rejected.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+
+from contextlib import redirect_stdout
+from .client import SERVED_COMMANDS, get_socket_path
+from .core import (create_tree_from_filesystem, read_created_links,
+                   update, plan, status, _get_jobs, Dir, File,
+                   CREATED_LINKS_FILENAME)
+from .logging import log_verbose
+
+
+def _copy_tree(items):
+    return [Dir(item.name, list(item.envs), _copy_tree(item.children))
+            if isinstance(item, Dir)
+            else File(item.name, list(item.envs))
+            for item in items]
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class WarmCache(object):
+    """Keeps the tree and created links between requests.
+
+    The tree is considered fresh while the list of envs, .dotignore and
+    mtimes of all scanned directories are the same. Adding, removing or
+    renaming of a file changes mtime of its directory, so checking
+    freshness costs one stat per directory instead of listing it.
+    """
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self._tree = None
+        self._tree_key = None
+        self._dir_mtimes = {}
+        self._created_links = None
+        self._created_links_mtime = None
+        self._created_links_home_dir = None
+
+    def _is_tree_fresh(self, key):
+        if self._tree is None or self._tree_key != key:
+            return False
+        return all(_mtime(path) == mtime
+                   for path, mtime in self._dir_mtimes.items())
+
+    def tree_builder(self, **options):
+        """Returns tree builder for update(). Options are passed
+        to create_tree_from_filesystem."""
+        def build(base_dir, envs, prefixes=None):
+            if prefixes is not None:
+                # partial trees are cheap and not cached
+                return create_tree_from_filesystem(
+                    base_dir, envs, prefixes=prefixes, **options)
+
+            key = (tuple(envs),
+                   options.get('tracked_only', False),
+                   _mtime(os.path.join(base_dir, '.dotignore')))
+
+            if self._is_tree_fresh(key):
+                log_verbose('Using cached tree')
+            else:
+                dir_mtimes = {}
+                self._tree = create_tree_from_filesystem(
+                    base_dir, envs, dir_mtimes=dir_mtimes, **options)
+                self._tree_key = key
+                self._dir_mtimes = dir_mtimes
+            # update changes envs of nodes when only some envs are updated
+            return _copy_tree(self._tree)
+        return build
+
+    def _created_links_filename(self):
+        return os.path.join(self.base_dir, CREATED_LINKS_FILENAME)
+
+    def get_created_links(self, home_dir):
+        mtime = _mtime(self._created_links_filename())
+        if (self._created_links is None
+                or mtime != self._created_links_mtime
+                or home_dir != self._created_links_home_dir):
+            # paths in the file are relative to the home_dir
+            self._created_links = read_created_links(self.base_dir, home_dir)
+            self._created_links_mtime = mtime
+            self._created_links_home_dir = home_dir
+        # processors modify a copy, but let's be safe
+        return dict(self._created_links)
+
+    def set_created_links(self, home_dir, created_links):
+        self._created_links = dict(created_links)
+        self._created_links_mtime = _mtime(self._created_links_filename())
+        self._created_links_home_dir = home_dir
+
+
+class _ForwardingHandler(logging.Handler):
+    def __init__(self, send):
+        super(_ForwardingHandler, self).__init__()
+        self._send = send
+
+    def emit(self, record):
+        self._send(dict(level=record.levelno,
+                        message=record.getMessage(),
+                        color=getattr(record, 'color', None)))
+
+
+class _StdoutWriter(object):
+    def __init__(self, send):
+        self._send = send
+
+    def write(self, text):
+        if text:
+            self._send(dict(stdout=text))
+
+    def flush(self):
+        pass
+
+
+def handle_request(cache, request, send):
+    """Runs a command described by request and sends its output
+    using the send callback."""
+    command = request['command']
+    base_dir = cache.base_dir
+    home_dir = request['home_dir']
+    args = request['args']
+
+    if command not in SERVED_COMMANDS:
+        raise ValueError('Unknown command "{0}"'.format(command))
+
+    handler = _ForwardingHandler(send)
+    logger = logging.getLogger(None)
+    original_level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
+    try:
+        with redirect_stdout(_StdoutWriter(send)):
+            tree_builder = cache.tree_builder(
+                jobs=_get_jobs(args),
+                tracked_only=args.get('--tracked-only', False))
+
+            if command == 'status':
+                status(base_dir, home_dir, args)
+            elif command == 'plan':
+                plan(base_dir, home_dir, args,
+                     tree_builder=tree_builder,
+                     created_links=cache.get_created_links(home_dir))
+            else:
+                created_links = update(
+                    base_dir, home_dir, args,
+                    tree_builder=tree_builder,
+                    created_links=cache.get_created_links(home_dir),
+                    served=True)
+                if not args['--dry']:
+                    cache.set_created_links(home_dir, created_links)
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(original_level)
+
+
+def _get_peer_uid(connection):
+    """Returns uid of the process on the other side of the unix
+    socket or None if the platform doesn't tell it."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', credentials)
+    return uid
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        def send(data):
+            self.wfile.write(json.dumps(data).encode('utf-8') + b'\n')
+
+        uid = _get_peer_uid(self.connection)
+        if uid is not None and uid != os.getuid():
+            logging.error('Rejected request of user with uid {0}'.format(uid))
+            send(dict(level=logging.ERROR, color='red',
+                      message='Daemon serves only its owner, use --no-server.'))
+            send(dict(done=True, exit_code=1))
+            return
+
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        exit_code = 0
+        try:
+            handle_request(self.server.cache, json.loads(line.decode('utf-8')), send)
+        except SystemExit as e:
+            # command wants the client to exit with this code
+            exit_code = e.code
+        except Exception as e:
+            logging.exception('Unable to process request')
+            send(dict(level=logging.ERROR, message=str(e), color='red'))
+            exit_code = 1
+        send(dict(done=True, exit_code=exit_code))
+
+
+def serve(base_dir, home_dir, args):
+    """Runs a daemon which answers requests from 'dot' commands."""
+    socket_path = get_socket_path(base_dir)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = socketserver.UnixStreamServer(socket_path, _RequestHandler,
+                                           bind_and_activate=False)
+    server.server_bind()
+    # nobody could connect before the socket is listening
+    os.chmod(socket_path, 0o600)
+    server.server_activate()
+    server.cache = WarmCache(base_dir)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log_verbose('Listening on {0}'.format(socket_path))
+
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
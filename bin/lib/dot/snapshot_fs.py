@@ -0,0 +1,109 @@
+# coding: utf-8
+"""Snapshot of home directories, taken before planning.
+
+Planner asks about every target and every intermediate directory.
+Instead of a few syscalls per path, SnapshotFS lists each directory
+which could contain targets once with os.scandir and answers questions
+about its entries from this listing.
+"""
+from __future__ import absolute_import
+
+import os
+
+from . import phases
+
+
+def get_touched_dirs(home_dir, tree):
+    """Returns home directories which planner will look into. These are
+    the home_dir itself and directories which are merged from many envs,
+    because only their children are linked separately."""
+    dirs = [home_dir]
+
+    def walk(items, prefix):
+        for item in items:
+            children = getattr(item, 'children', [])
+            if len(item.envs) > 1 and children:
+                path = os.path.join(prefix, item.name)
+                dirs.append(path)
+                walk(children, path)
+
+    walk(tree, home_dir)
+    return dirs
+
+
+class SnapshotFS(object):
+    """Wraps a filesystem and answers exists, is_symlink and
+    get_symlink_target for entries of listed directories
+    without asking it."""
+
+    # already a snapshot
+    can_scandir = False
+
+    def __init__(self, fs, dirs):
+        self._fs = fs
+        # dir -> {name: state}, where state is 'dir', 'file' or
+        # ['link', target], like in RealFS.get_state
+        self._listings = {}
+        self._listed = set()
+        self.add_dirs(dirs)
+
+    def add_dirs(self, dirs):
+        """Lists directories, which were not listed yet. Other threads
+        could ask about already listed directories meanwhile."""
+        dirs = [path for path in dirs if path not in self._listed]
+        if not dirs:
+            return
+
+        with phases.phase('fs-batch', 'list {0} dirs'.format(len(dirs))):
+            for path in dirs:
+                self._listed.add(path)
+                listing = self._list(path)
+                if listing is not None:
+                    self._listings[path] = listing
+
+    def __getattr__(self, name):
+        return getattr(self._fs, name)
+
+    def _list(self, path):
+        listing = {}
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        listing[entry.name] = ['link', os.readlink(entry.path)]
+                    elif entry.is_dir(follow_symlinks=False):
+                        listing[entry.name] = 'dir'
+                    else:
+                        listing[entry.name] = 'file'
+        except OSError:
+            # missing or not a directory, real filesystem
+            # will answer for paths inside of it
+            return None
+        return listing
+
+    def _lookup(self, path):
+        """Returns (True, state) if path is inside of one of listed
+        directories and (False, None) otherwise."""
+        dirname, name = os.path.split(path)
+        listing = self._listings.get(dirname)
+        if listing is None:
+            return False, None
+        return True, listing.get(name)
+
+    def exists(self, path):
+        known, state = self._lookup(path)
+        if not known:
+            return self._fs.exists(path)
+        return state is not None
+
+    def is_symlink(self, path):
+        known, state = self._lookup(path)
+        if not known:
+            return self._fs.is_symlink(path)
+        return isinstance(state, list)
+
+    def get_symlink_target(self, path):
+        known, state = self._lookup(path)
+        if not known or not isinstance(state, list):
+            return self._fs.get_symlink_target(path)
+        return state[1]
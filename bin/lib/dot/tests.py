@@ -1,7 +1,13 @@
 # coding: utf-8
+import shutil
+import tempfile
+
+from contextlib import contextmanager
 from .core import *
-from .core import _normalize_url
+from .core import (_normalize_url, _filter_created_links, _get_replaced_ancestors,
+                   _get_sparse_patterns, _get_changed_paths, _get_incremental_prefixes)
 from .virtual_fs import VirtualFS
+from .server import WarmCache
 from nose.tools import eq_
 
 
@@ -49,6 +55,28 @@ class FakeFilesystem(object):
         del self.structure[path]
 
 
+@contextmanager
+def temp_tree(paths=()):
+    """Creates a temporary directory and yields its path. Paths are
+    relative to it: ones ending with a slash become directories, others
+    become files. If paths is a dict, its values are contents of files.
+    The directory is removed afterwards."""
+    if not isinstance(paths, dict):
+        paths = dict.fromkeys(paths)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for path, content in paths.items():
+            full_path = os.path.join(tmp_dir, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            if not path.endswith('/'):
+                with open(full_path, 'w') as f:
+                    f.write(content or '')
+        yield tmp_dir
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
 def test_fakefs_realpath2():
     filesystem = FakeFilesystem("""
     /home/art/.zsh/ -> /home/art/.dotfiles/zsh/.zsh
@@ -184,6 +212,45 @@ def test_actions_already_linked():
         actions)
 
 
+def test_actions_already_linked_without_realpath():
+    class NoRealpathFilesystem(FakeFilesystem):
+        def realpath(self, path):
+            raise AssertionError('realpath should not be called')
+
+    filesystem = NoRealpathFilesystem("""
+    /home/art/.zsh/
+    /home/art/.zsh/aliases -> ../.dotfiles/base/.zsh/aliases
+    /home/art/.zshrc -> /home/art/.dotfiles/base/.zshrc
+    """)
+    tree = create_tree("""
+    base/.zshrc
+    base/.zsh/aliases
+    other/.zsh/env
+    """)
+    actions = create_install_actions(base_dir, home_dir, tree, filesystem)
+    eq_([('already-linked', '/home/art/.dotfiles/base/.zsh/aliases', '/home/art/.zsh/aliases'),
+         ('link', '/home/art/.dotfiles/other/.zsh/env', '/home/art/.zsh/env'),
+         ('already-linked', '/home/art/.dotfiles/base/.zshrc', '/home/art/.zshrc')],
+        actions)
+
+
+def test_actions_relative_links():
+    filesystem = FakeFilesystem("""
+    /home/art/.vimrc -> .dotfiles/base/.vimrc
+    /home/art/.zshrc -> /home/art/.dotfiles/base/.zshrc
+    """)
+    tree = create_tree("""
+    base/.vimrc
+    base/.zshrc
+    """)
+    actions = create_install_actions(base_dir, home_dir, tree, filesystem,
+                                     relative=True)
+    eq_([('already-linked', '/home/art/.dotfiles/base/.vimrc', '/home/art/.vimrc'),
+         ('rm', '/home/art/.zshrc'),
+         ('link', '/home/art/.dotfiles/base/.zshrc', '/home/art/.zshrc')],
+        actions)
+
+
 def test_actions_link_only_parent_dir():
     """Если внутри директории файлы только одного окружения, то линкуется сама директория, а не файлы."""
     filesystem = FakeFilesystem("")
@@ -389,6 +456,32 @@ def test_rm_file():
     eq_(False, fs.exists('/home/art/.zsh/aliases'))
 
 
+def test_realpath_is_memoized_until_changes():
+    base_fs = FakeFilesystem("""
+    /home/art/.zsh/ -> /home/art/.dotfiles/zsh/.zsh
+    /home/art/.dotfiles/zsh/.zsh/aliases
+    """)
+    fs = VirtualFS(base_fs)
+    eq_('/home/art/.dotfiles/zsh/.zsh/aliases', fs.realpath('/home/art/.zsh/aliases'))
+
+    base_fs.structure.clear()
+    eq_('/home/art/.dotfiles/zsh/.zsh/env', fs.realpath('/home/art/.zsh/env'))
+
+    fs.rm('/home/art/.zsh')
+    fs.mkdir('/home/art/.zsh')
+    eq_('/home/art/.zsh/env', fs.realpath('/home/art/.zsh/env'))
+
+
+def test_realpath_detects_symlink_loops():
+    from nose.tools import assert_raises
+    fs = VirtualFS(FakeFilesystem("""
+    /home/art/.a -> /home/art/.b
+    /home/art/.b -> .a
+    """))
+    with assert_raises(OSError):
+        fs.realpath('/home/art/.a/file')
+
+
 def test_rm_dir():
     base_fs = FakeFilesystem("""
     /home/art/.zsh/aliases
@@ -487,3 +580,841 @@ def test_osx_library_already_exists_and_we_should_symlink_into_it():
     actions = create_install_actions(base_dir, home_dir, tree, fs)
     eq_([('link', '/home/art/.dotfiles/osx/Library/KeyBindings', '/home/art/Library/KeyBindings'),
      ], actions)
+
+
+def test_create_tree_from_filesystem_is_same_for_any_number_of_workers():
+    with temp_tree(['zsh/.zshrc',
+                    'zsh/.zsh/aliases',
+                    'zsh/.git/config',
+                    'git/.gitconfig',
+                    'git/.zsh/git-prompt',
+                    'emacs/.emacs.d/lisp/init.el']) as tmp_dir:
+        envs = ['zsh', 'git', 'emacs']
+        expected = create_tree("""
+        emacs/.emacs.d/lisp/init.el
+        git/.gitconfig
+        git/.zsh/git-prompt
+        zsh/.zsh/aliases
+        zsh/.zshrc
+        """)
+        eq_(expected, create_tree_from_filesystem(tmp_dir, envs, jobs=1))
+        eq_(expected, create_tree_from_filesystem(tmp_dir, envs, jobs=8))
+
+
+def test_warm_cache_rescans_tree_only_when_directories_changed():
+    with temp_tree(['zsh/.zsh/aliases']) as tmp_dir:
+        build = WarmCache(tmp_dir).tree_builder()
+        tree = build(tmp_dir, ['zsh'])
+        # requests could change the tree they got
+        tree[0].envs.append('other')
+
+        dir_path = os.path.join(tmp_dir, 'zsh', '.zsh')
+        mtime = os.stat(dir_path).st_mtime_ns
+        open(os.path.join(dir_path, 'functions'), 'w').close()
+        # while mtimes are the same, the cached tree is used
+        os.utime(dir_path, ns=(mtime, mtime))
+        eq_(create_tree('zsh/.zsh/aliases'), build(tmp_dir, ['zsh']))
+
+        # make sure mtime will differ even on filesystems with coarse mtimes
+        os.utime(dir_path, ns=(0, 0))
+        eq_(create_tree("""
+        zsh/.zsh/aliases
+        zsh/.zsh/functions
+        """), build(tmp_dir, ['zsh']))
+
+
+def test_daemon_rejects_requests_of_other_users():
+    import json
+    import socket
+    from unittest import mock
+    from .server import _RequestHandler
+
+    server_side, client_side = socket.socketpair(socket.AF_UNIX)
+    with server_side, client_side:
+        client_side.sendall(b'{"command": "status"}\n')
+        server = mock.Mock(cache=None)
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            _RequestHandler(server_side, '', server)
+        server_side.shutdown(socket.SHUT_WR)
+
+        with client_side.makefile('rb') as f:
+            responses = [json.loads(line.decode('utf-8')) for line in f]
+    eq_(['Daemon serves only its owner, use --no-server.'],
+        [response['message'] for response in responses if 'message' in response])
+    eq_(dict(done=True, exit_code=1), responses[-1])
+
+
+def test_partial_tree_knows_about_dirs_shared_with_other_envs():
+    with temp_tree(['zsh/.zsh/aliases',
+                    'zsh/.zshrc',
+                    'git/.zsh/git-prompt',
+                    'git/.gitconfig']) as tmp_dir:
+        tree = create_tree_from_filesystem(tmp_dir, ['git'], prefixes=['.zsh'])
+        tree = add_unscanned_envs(tmp_dir, tree, ['git', 'zsh'], ['git'], ['.zsh'])
+        eq_([Dir('.zsh', envs=['git', 'zsh'], children=[
+            File('git-prompt', envs=['git'])])],
+            tree)
+
+
+def test_filter_created_links_by_envs_and_prefixes():
+    created_links = {'/home/art/.zsh/aliases': '/home/art/.dotfiles/zsh/.zsh/aliases',
+                     '/home/art/.zshrc': '/home/art/.dotfiles/zsh/.zshrc',
+                     '/home/art/.zsh/git': '/home/art/.dotfiles/git/.zsh/git'}
+    eq_({'/home/art/.zsh/aliases': '/home/art/.dotfiles/zsh/.zsh/aliases'},
+        _filter_created_links(created_links, base_dir, home_dir, ['zsh'], ['.zsh']))
+
+
+def test_intermediate_dirs_are_checked_once():
+    class CountingFilesystem(FakeFilesystem):
+        def __init__(self, text):
+            super(CountingFilesystem, self).__init__(text)
+            self.checked = []
+
+        def exists(self, path):
+            self.checked.append(path)
+            return super(CountingFilesystem, self).exists(path)
+
+    filesystem = CountingFilesystem("""
+    /home/art/.config/
+    """)
+    tree = create_tree('\n'.join(
+        ['base/.config/app/conf.d/file-{0}'.format(i) for i in range(10)] +
+        ['develop/.config/app/conf.d/other-{0}'.format(i) for i in range(10)]))
+
+    actions = create_install_actions(base_dir, home_dir, tree, filesystem)
+    eq_([('mkdir', '/home/art/.config/app'),
+         ('mkdir', '/home/art/.config/app/conf.d')],
+        actions[:2])
+    eq_(22, len(actions))
+    eq_(1, filesystem.checked.count('/home/art/.config'))
+
+
+def test_replaced_symlinked_ancestor_is_planned_as_a_whole():
+    """If incremental plan replaces directory symlink with a real dir,
+    then everything inside of it should be planned again."""
+    filesystem = FakeFilesystem("""
+    /home/art/.zsh/ -> /home/art/.dotfiles/zsh/.zsh
+    """)
+    tree = create_tree("""
+    git/.zsh/git-prompt
+    zsh/.zsh/aliases
+    """)
+    actions = create_install_actions(base_dir, home_dir, tree, filesystem)
+    eq_(['.zsh'],
+        _get_replaced_ancestors(actions, home_dir, ['.zsh/git-prompt']))
+    eq_([],
+        _get_replaced_ancestors(actions, home_dir, ['.zshrc']))
+
+
+def test_incremental_prefixes_are_files_added_or_removed_by_pull():
+    import subprocess
+
+    with temp_tree(['zsh/.zshrc', 'zsh/.zsh/aliases', 'zsh/.bashrc', 'git/']) as tmp_dir:
+        env_path = os.path.join(tmp_dir, 'zsh')
+
+        def commit(*args):
+            subprocess.check_call(['git', '-c', 'user.name=dot', '-c', 'user.email=dot@example.com',
+                                   'commit', '--quiet', '-a', '-m', 'change'] + list(args),
+                                  cwd=env_path)
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=env_path, universal_newlines=True).strip()
+
+        subprocess.check_call(['git', 'init', '--quiet'], cwd=env_path)
+        subprocess.check_call(['git', 'add', '.'], cwd=env_path)
+        old_head = commit()
+
+        open(os.path.join(env_path, '.zsh', 'functions'), 'w').close()
+        subprocess.check_call(['git', 'add', '.zsh/functions'], cwd=env_path)
+        subprocess.check_call(['git', 'rm', '--quiet', '.bashrc'], cwd=env_path)
+        commit()
+        with open(os.path.join(env_path, '.zshrc'), 'w') as f:
+            f.write('export EDITOR=vim\n')
+        new_head = commit()
+
+        # modified files are linked already
+        eq_(['.bashrc', '.zsh/functions'],
+            _get_changed_paths(tmp_dir, 'zsh', old_head, new_head))
+        eq_([], _get_changed_paths(tmp_dir, 'zsh', new_head, new_head))
+
+        # git env has no upstream and wasn't pulled
+        heads = {'zsh': (old_head, new_head), 'git': None}
+        eq_(['.bashrc', os.path.join('.zsh', 'functions')],
+            _get_incremental_prefixes(tmp_dir, ['zsh', 'git'], heads, None))
+        eq_([os.path.join('.zsh', 'functions')],
+            _get_incremental_prefixes(tmp_dir, ['zsh', 'git'], heads, ['.zsh']))
+
+        # after rewrite of the history nothing could be told
+        rewritten_head = commit('--amend', '-m', 'rewritten')
+        eq_(None, _get_changed_paths(tmp_dir, 'zsh', new_head, rewritten_head))
+        eq_(None, _get_incremental_prefixes(tmp_dir, ['zsh'],
+                                            {'zsh': (new_head, rewritten_head)}, None))
+
+
+def test_incremental_update_replans_modified_copies():
+    import subprocess
+    from .copies import COPY_FILENAME
+
+    with temp_tree({'ssh/.ssh/config': 'Host *\n',
+                    'ssh/.bashrc': '',
+                    'ssh/' + COPY_FILENAME: '.ssh/*\n'}) as tmp_dir:
+        env_path = os.path.join(tmp_dir, 'ssh')
+
+        def commit():
+            subprocess.check_call(['git', '-c', 'user.name=dot', '-c', 'user.email=dot@example.com',
+                                   'commit', '--quiet', '-a', '-m', 'change'],
+                                  cwd=env_path)
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=env_path, universal_newlines=True).strip()
+
+        subprocess.check_call(['git', 'init', '--quiet'], cwd=env_path)
+        subprocess.check_call(['git', 'add', '.'], cwd=env_path)
+        old_head = commit()
+
+        for filename in ('.ssh/config', '.bashrc'):
+            with open(os.path.join(env_path, filename), 'a') as f:
+                f.write('# changed\n')
+        new_head = commit()
+        eq_(['.ssh/config'], _get_changed_paths(tmp_dir, 'ssh', old_head, new_head))
+
+        # other files could become copies
+        with open(os.path.join(env_path, COPY_FILENAME), 'a') as f:
+            f.write('.bashrc\n')
+        eq_(None, _get_changed_paths(tmp_dir, 'ssh', new_head, commit()))
+
+
+def test_create_tree_from_git_index():
+    import subprocess
+
+    with temp_tree(['emacs/.emacs.d/init.el',
+                    'emacs/.emacs.d/init.elc',
+                    'emacs/.emacs.d/vendor/.git',
+                    'emacs/.emacs.d/vendor/magit.el',
+                    'zsh/.zshrc']) as tmp_dir:
+        env_path = os.path.join(tmp_dir, 'emacs')
+        subprocess.check_call(['git', 'init', '-q', env_path])
+        subprocess.check_call(['git', '-C', env_path, 'add', '.emacs.d/init.el'])
+        # submodules are gitlinks in the index, their checkouts are walked
+        subprocess.check_call(['git', '-C', env_path, 'update-index', '--add', '--cacheinfo',
+                               '160000,' + '1' * 40 + ',.emacs.d/vendor'])
+
+        # zsh is not a repository and should be walked as usual
+        eq_(create_tree("""
+        emacs/.emacs.d/init.el
+        emacs/.emacs.d/vendor/magit.el
+        zsh/.zshrc
+        """), create_tree_from_filesystem(tmp_dir, ['emacs', 'zsh'],
+                                          tracked_only=True))
+
+
+def test_plan_cache_reuses_actions_while_home_is_the_same():
+    from .plan_cache import PlanCache
+
+    class FingerprintedFilesystem(FakeFilesystem):
+        def fingerprint(self, path):
+            return self.structure.get(path)
+
+    filesystem = FingerprintedFilesystem("""
+    /home/art/.zsh/
+    """)
+    tree = create_tree("""
+    base/.zsh/aliases
+    develop/.zsh/git-prompt
+    base/.zshrc
+    """)
+
+    with temp_tree() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'plan-cache')
+        cache = PlanCache(filename, base_dir, home_dir, filesystem)
+        actions = create_install_actions(base_dir, home_dir, tree, filesystem,
+                                         plan_cache=cache)
+        cache.save()
+        eq_((0, 2), (cache.hits, cache.misses))
+
+        cache = PlanCache(filename, base_dir, home_dir, filesystem)
+        eq_(actions, create_install_actions(base_dir, home_dir, tree, filesystem,
+                                            plan_cache=cache))
+        eq_((2, 0), (cache.hits, cache.misses))
+
+        # now user created a file in the home dir
+        filesystem.structure['/home/art/.zshrc'] = (False, None)
+        cache = PlanCache(filename, base_dir, home_dir, filesystem)
+        actions = create_install_actions(base_dir, home_dir, tree, filesystem,
+                                         plan_cache=cache)
+        eq_((1, 1), (cache.hits, cache.misses))
+        eq_(('error', 'File /home/art/.zshrc already exists, can\'t make symlink instead of it.'),
+            actions[-1])
+
+
+def test_pipelined_actions_are_the_same_as_sequential():
+    with temp_tree(['zsh/.zsh/aliases',
+                    'zsh/.zshrc',
+                    'git/.zsh/git-prompt',
+                    'git/.gitconfig',
+                    'emacs/.emacs.d/init.el',
+                    'other/.emacs.d/init.el']) as tmp_dir:
+        envs = ['emacs', 'git', 'other', 'zsh']
+        filesystem = FakeFilesystem("")
+        tree = create_tree_from_filesystem(tmp_dir, envs)
+        eq_(create_install_actions(tmp_dir, home_dir, tree, filesystem),
+            create_actions_pipelined(tmp_dir, home_dir, envs, filesystem,
+                                     pull=False))
+
+
+def test_sparse_patterns_exclude_ignored_files_and_dirs():
+    import re
+    import subprocess
+
+    with temp_tree(['.emacs.d/init.el',
+                    '.fonts/a.ttf',
+                    '.fonts/b.ttf',
+                    '.themes/README',
+                    '.themes/dark.theme',
+                    'README.md',
+                    '.gitmodules']) as tmp_dir:
+        subprocess.check_call(['git', 'init', '-q', tmp_dir])
+        subprocess.check_call(['git', '-C', tmp_dir, 'add', '.'])
+        subprocess.check_call(['git', '-C', tmp_dir,
+                               '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                               'commit', '-q', '-m', 'initial'])
+
+        ignored_files_re = re.compile(r'(readme.*|.*\.ttf|\.gitmodules)$', re.I)
+        eq_(['/*', '!/.fonts/', '!/.themes/README', '!/README.md'],
+            _get_sparse_patterns(tmp_dir, ignored_files_re))
+
+
+def test_plan_file_preconditions():
+    from .plan_file import write_plan, read_plan, check_preconditions
+    from .real_filesystem import RealFS
+
+    with temp_tree() as tmp_dir:
+        fs = RealFS()
+        target = os.path.join(tmp_dir, '.zshrc')
+        actions = [('link', '/home/art/.dotfiles/zsh/.zshrc', target)]
+        filename = os.path.join(tmp_dir, 'plan.json')
+        write_plan(filename, base_dir, home_dir, actions, fs)
+
+        plan = read_plan(filename)
+        eq_(actions, plan['actions'])
+        eq_([], check_preconditions(plan, fs))
+
+        open(target, 'w').close()
+        eq_(['{0} was expected to be missing, but it is a file.'.format(target)],
+            check_preconditions(plan, fs))
+
+        # copies should be known to created links of this machine
+        source = '/home/art/.dotfiles/ssh/.ssh/config'
+        actions = [('already-copied', source, target)]
+        write_plan(filename, base_dir, home_dir, actions, fs)
+        plan = read_plan(filename)
+        eq_(['{0} was expected to be a copy of {1}, but it was not copied by dot.'.format(target, source)],
+            check_preconditions(plan, fs, created_links={}))
+        eq_([], check_preconditions(plan, fs, created_links={
+            target: CopiedFile(source, (7, 1), (7, 1), 'sha1')}))
+
+
+def test_find_conflicts():
+    paths = ['/home/art/.dotfiles/emacs/.zshrc',
+             '/home/art/.dotfiles/git/.gitconfig',
+             '/home/art/.dotfiles/zsh/.gitconfig/include',
+             '/home/art/.dotfiles/zsh/.zsh/aliases',
+             '/home/art/.dotfiles/zsh/.zshrc']
+    eq_([dict(path='.gitconfig', envs=['git', 'zsh'], type='file-and-dir'),
+         dict(path='.zshrc', envs=['emacs', 'zsh'], type='file')],
+        find_conflicts(base_dir, paths))
+
+
+def test_snapshot_fs_answers_from_listing():
+    from .snapshot_fs import SnapshotFS, get_touched_dirs
+
+    class FailingFS(object):
+        def exists(self, path):
+            raise AssertionError('{0} is in the snapshot'.format(path))
+        is_symlink = get_symlink_target = exists
+
+    with temp_tree(['.zsh/env']) as tmp_dir:
+        os.symlink('/home/art/.dotfiles/zsh/.zshrc', os.path.join(tmp_dir, '.zshrc'))
+
+        tree = create_tree("""
+        zsh/.zshrc
+        zsh/.zsh/env
+        other/.zsh/aliases
+        """)
+        dirs = get_touched_dirs(tmp_dir, tree)
+        eq_([tmp_dir, os.path.join(tmp_dir, '.zsh')], dirs)
+
+        fs = SnapshotFS(FailingFS(), dirs)
+        eq_(True, fs.is_symlink(os.path.join(tmp_dir, '.zshrc')))
+        eq_('/home/art/.dotfiles/zsh/.zshrc',
+            fs.get_symlink_target(os.path.join(tmp_dir, '.zshrc')))
+        eq_(True, fs.exists(os.path.join(tmp_dir, '.zsh', 'env')))
+        eq_(False, fs.is_symlink(os.path.join(tmp_dir, '.zsh', 'env')))
+        eq_(False, fs.exists(os.path.join(tmp_dir, '.zsh', 'aliases')))
+
+
+def test_sharded_planning_is_same_as_serial():
+    from .real_filesystem import RealFS
+
+    with temp_tree(['.config/']) as tmp_dir:
+        os.symlink('/home/art/.dotfiles/zsh/.zshrc', os.path.join(tmp_dir, '.zshrc'))
+        tree = create_tree("""
+        zsh/.zshrc
+        zsh/.config/fish/config.fish
+        nvim/.config/nvim/init.vim
+        nvim/.config/nvim/lua/plugins.lua
+        tmux/.tmux.conf
+        """)
+        eq_(create_install_actions(base_dir, tmp_dir, tree, RealFS()),
+            create_install_actions_sharded(base_dir, tmp_dir, tree, 2))
+
+
+def test_sort_by_dependencies():
+    from .core import _sort_by_dependencies
+
+    with temp_tree({'emacs/' + DEPENDENCIES_FILENAME: 'svetlyak40wt/dot-fonts\n# comment\n',
+                    'fonts/' + DEPENDENCIES_FILENAME: '',
+                    'zsh/' + DEPENDENCIES_FILENAME: 'https://github.com/svetlyak40wt/dot-emacs.git\n'}) as tmp_dir:
+        eq_(['fonts', 'emacs', 'zsh'],
+            _sort_by_dependencies(tmp_dir, ['zsh', 'emacs', 'fonts']))
+        # manifests are not linked
+        eq_([], scan_envs(tmp_dir, ['zsh', 'emacs', 'fonts']))
+
+
+def test_pipelined_pulls_wait_for_dependencies():
+    import time
+    from unittest import mock
+
+    pulls = []
+
+    def make_pull(base_dir, env, **options):
+        if env == 'fonts':
+            time.sleep(0.2)
+        pulls.append(env)
+
+    with temp_tree({'zsh/' + DEPENDENCIES_FILENAME: 'svetlyak40wt/dot-fonts\n',
+                    'fonts/.fonts/': None,
+                    'home/': None}) as tmp_dir:
+        with mock.patch('dot.core.make_pull', make_pull):
+            create_actions_pipelined(tmp_dir, os.path.join(tmp_dir, 'home'),
+                                     ['zsh', 'fonts'], FakeFilesystem(''), jobs=2)
+    eq_(['fonts', 'zsh'], pulls)
+
+
+def test_memory_budget_of_planning():
+    from .memory_profile import MemoryProfiler
+    from . import phases
+
+    paths = ['{0}/env{1}/.config/app{2}/file{3}'.format(base_dir, i % 3, i // 100, i)
+             for i in range(2000)]
+    paths.sort()
+
+    with MemoryProfiler() as profiler, phases.observe(profiler):
+        with phases.phase('scan'):
+            tree = create_tree_from_paths(base_dir, paths)
+        phases.count('files', len(paths))
+        with phases.phase('plan'):
+            create_install_actions(base_dir, home_dir, tree, FakeFilesystem(''))
+
+    eq_(['scan', 'plan'], [name for name, peak, sites in profiler.phases])
+    eq_([], profiler.check_budget())
+
+
+def test_update_over_memory_budget_exits_with_error():
+    from unittest import mock
+
+    with temp_tree(['base/zsh/.zshrc', 'home/']) as tmp_dir:
+        base = os.path.join(tmp_dir, 'base')
+        home = os.path.join(tmp_dir, 'home')
+        args = {'--dry': False, '--skip-pull': True, '--profile-memory': True}
+
+        with mock.patch('dot.memory_profile.BUDGET_PER_10K_FILES', 0):
+            try:
+                update(base, home, args)
+            except SystemExit as e:
+                eq_(1, e.code)
+            else:
+                raise AssertionError('update should exit')
+        # links are created anyway
+        assert os.path.islink(os.path.join(home, '.zshrc'))
+
+
+def test_hooks_are_run_when_inputs_change():
+    from .hooks import run_hooks, HOOKS_FILENAME
+
+    with temp_tree({'zsh/.zsh/': None,
+                    'zsh/' + HOOKS_FILENAME: '.zsh/*: echo run >> "$DOT_BASE_DIR/log"\n'}) as tmp_dir:
+        def runs():
+            run_hooks(tmp_dir, tmp_dir, ['zsh'])
+            with open(os.path.join(tmp_dir, 'log')) as f:
+                return len(f.readlines())
+
+        eq_(1, runs())
+        eq_(1, runs())
+        with open(os.path.join(tmp_dir, 'zsh', '.zsh', 'aliases'), 'w') as f:
+            f.write('alias ll="ls -l"\n')
+        eq_(2, runs())
+
+
+def test_copies_are_updated_only_when_source_changes():
+    from .real_filesystem import RealFS
+
+    with temp_tree({'base/ssh/.ssh/config': 'Host *\n',
+                    'home/': None}) as tmp_dir:
+        base = os.path.join(tmp_dir, 'base')
+        home = os.path.join(tmp_dir, 'home')
+        source = os.path.join(base, 'ssh', '.ssh', 'config')
+        target = os.path.join(home, '.ssh', 'config')
+
+        tree = create_tree('ssh/.ssh/config')
+        fs = RealFS()
+
+        def update(created_links):
+            actions = create_install_actions(base, home, tree, fs,
+                                             copy_patterns={'ssh': ['.ssh/*']},
+                                             created_links=created_links)
+            return actions, processor_real(actions, created_links, fs)
+
+        actions, created_links = update({})
+        eq_([('mkdir', os.path.join(home, '.ssh')),
+             ('copy', source, target)],
+            actions)
+        eq_(False, os.path.islink(target))
+
+        # copies survive a round trip through the store
+        write_created_links(base, home, created_links)
+        created_links = read_created_links(base, home)
+        eq_([('already-copied', source, target)], update(created_links)[0])
+
+        with open(source, 'w') as f:
+            f.write('Host example.com\n')
+        actions, created_links = update(created_links)
+        eq_([('copy', source, target)], actions)
+        with open(target) as f:
+            eq_('Host example.com\n', f.read())
+
+
+def test_relative_link_of_intermediate_dir_is_replaced_for_second_env():
+    from .real_filesystem import RealFS
+
+    with temp_tree(['base/zsh/.config/fish/config.fish',
+                    'base/git/.config/fish/functions/g.fish',
+                    'home/']) as tmp_dir:
+        base = os.path.join(tmp_dir, 'base')
+        home = os.path.join(tmp_dir, 'home')
+        fs = RealFS(relative_links=True)
+
+        actions = create_install_actions(base, home, create_tree('zsh/.config/fish/config.fish'),
+                                         fs, relative=True)
+        processor_real(actions, {}, fs)
+        eq_(os.path.join('..', 'base', 'zsh', '.config'),
+            os.readlink(os.path.join(home, '.config')))
+
+        actions = create_install_actions(base, home, create_tree("""
+        zsh/.config/fish/config.fish
+        git/.config/fish/functions/g.fish
+        """), fs, relative=True)
+        eq_([('rm', os.path.join(home, '.config')),
+             ('mkdir', os.path.join(home, '.config')),
+             ('mkdir', os.path.join(home, '.config', 'fish')),
+             ('link', os.path.join(base, 'zsh', '.config', 'fish', 'config.fish'),
+              os.path.join(home, '.config', 'fish', 'config.fish')),
+             ('link', os.path.join(base, 'git', '.config', 'fish', 'functions'),
+              os.path.join(home, '.config', 'fish', 'functions'))],
+            actions)
+        processor_real(actions, {}, fs)
+        eq_(os.path.join('..', '..', '..', 'base', 'git', '.config', 'fish', 'functions'),
+            os.readlink(os.path.join(home, '.config', 'fish', 'functions')))
+
+
+def test_created_links_are_known_after_base_and_home_were_moved():
+    from .real_filesystem import RealFS
+
+    with temp_tree(['old/base/zsh/.zshrc',
+                    'old/base/zsh/.zprofile']) as tmp_dir:
+        base = os.path.join(tmp_dir, 'old', 'base')
+        home = os.path.join(tmp_dir, 'old')
+        fs = RealFS(relative_links=True)
+
+        actions = create_install_actions(base, home, create_tree("""
+        zsh/.zshrc
+        zsh/.zprofile
+        """), fs, relative=True)
+        write_created_links(base, home, processor_real(actions, {}, fs))
+
+        os.rename(home, os.path.join(tmp_dir, 'new'))
+        base = os.path.join(tmp_dir, 'new', 'base')
+        home = os.path.join(tmp_dir, 'new')
+        os.unlink(os.path.join(base, 'zsh', '.zprofile'))
+
+        created_links = read_created_links(base, home)
+        eq_({os.path.join(home, '.zshrc'): os.path.join(base, 'zsh', '.zshrc'),
+             os.path.join(home, '.zprofile'): os.path.join(base, 'zsh', '.zprofile')},
+            created_links)
+        eq_([('rm', os.path.join(home, '.zprofile'))],
+            create_actions_to_remove_broken_symlinks(created_links, fs))
+
+
+def test_mirror_is_fetched_only_when_stale():
+    import subprocess
+    from .mirrors import refresh_mirror, get_mirror_path, STAMP_FILENAME
+
+    with temp_tree() as tmp_dir:
+        origin = os.path.join(tmp_dir, 'origin')
+        mirrors = os.path.join(tmp_dir, 'mirrors')
+        subprocess.check_call(['git', 'init', '--quiet', origin])
+        subprocess.check_call(['git', '-C', origin, '-c', 'user.name=dot', '-c', 'user.email=dot@example.com',
+                               'commit', '--quiet', '--allow-empty', '-m', 'init'])
+
+        path = refresh_mirror(mirrors, origin)
+        eq_(get_mirror_path(mirrors, origin), path)
+        stamp = os.path.join(path, STAMP_FILENAME)
+        os.utime(stamp, (0, 0))
+
+        # fresh mirror is not fetched again
+        refresh_mirror(mirrors, origin, max_age=float('inf'))
+        eq_(0, os.stat(stamp).st_mtime)
+
+        refresh_mirror(mirrors, origin, max_age=60)
+        assert os.stat(stamp).st_mtime > 0
+
+
+def test_mirror_is_refreshed_only_for_envs_borrowing_from_it():
+    import subprocess
+    from .mirrors import refresh_mirror, get_mirror_path, borrows_from
+
+    with temp_tree() as tmp_dir:
+        origin = os.path.join(tmp_dir, 'origin')
+        mirrors = os.path.join(tmp_dir, 'mirrors')
+        subprocess.check_call(['git', 'init', '--quiet', origin])
+        subprocess.check_call(['git', '-C', origin, '-c', 'user.name=dot', '-c', 'user.email=dot@example.com',
+                               'commit', '--quiet', '--allow-empty', '-m', 'init'])
+        subprocess.check_call(['git', 'clone', '--quiet', origin, os.path.join(tmp_dir, 'plain')])
+
+        # env cloned without the mirror doesn't get one
+        make_pull(tmp_dir, 'plain', mirror_dir=mirrors)
+        eq_(False, os.path.exists(mirrors))
+
+        path = refresh_mirror(mirrors, origin)
+        subprocess.check_call(['git', 'clone', '--quiet', '--reference', path,
+                               origin, os.path.join(tmp_dir, 'referenced')])
+        eq_(False, borrows_from(os.path.join(tmp_dir, 'plain'), path))
+        eq_(True, borrows_from(os.path.join(tmp_dir, 'referenced'), path))
+        eq_(False, borrows_from(os.path.join(tmp_dir, 'referenced'),
+                                get_mirror_path(mirrors, 'https://example.com/other.git')))
+
+
+def test_unavailable_mirror_is_skipped_and_shared_files_are_group_writable():
+    import stat
+    import subprocess
+    from .core import _refresh_mirror
+    from .mirrors import get_mirror_path, STAMP_FILENAME
+
+    with temp_tree() as tmp_dir:
+        mirrors = os.path.join(tmp_dir, 'mirrors')
+        eq_(None, _refresh_mirror(mirrors, os.path.join(tmp_dir, 'offline')))
+
+        origin = os.path.join(tmp_dir, 'origin')
+        subprocess.check_call(['git', 'init', '--quiet', origin])
+        path = _refresh_mirror(mirrors, origin)
+        eq_(get_mirror_path(mirrors, origin), path)
+        for filename in (path + '.lock', os.path.join(path, STAMP_FILENAME)):
+            assert os.stat(filename).st_mode & stat.S_IWGRP, filename
+        assert os.stat(mirrors).st_mode & stat.S_IWGRP
+
+
+def test_history_records_phases_and_counts():
+    from . import phases
+    from .history import (HistoryRecorder, append_record, read_history,
+                          format_stats, percentile)
+
+    with temp_tree() as tmp_dir:
+        for i in range(3):
+            with HistoryRecorder() as recorder, phases.observe(recorder):
+                with phases.phase('scan'):
+                    phases.count('files', 10)
+                phases.count('files', 5)
+            append_record(tmp_dir, recorder.get_record(dry=False, served=i == 2))
+
+        records = read_history(tmp_dir)
+        eq_(3, len(records))
+        eq_({'files': 15}, records[-1]['counts'])
+        eq_(['scan', 'total'], sorted(records[-1]['durations']))
+        stats = format_stats(records)
+        eq_('2 runs', stats[0][:6])
+        eq_('Runs served by the daemon are not included: 1.', stats[1])
+
+    eq_(5, percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50))
+    eq_(10, percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 99))
+
+
+def test_metrics_of_other_commands_are_kept():
+    from .metrics import write_metrics
+
+    with temp_tree() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'dot.prom')
+        write_metrics(filename, 'dot_status_', [
+            ('dot_status_env_dirty_files', 'gauge', 'Dirty files.',
+             [({'env': 'zsh'}, 2), ({'env': 'say "hi"'}, 0)])])
+        write_metrics(filename, 'dot_update_', [
+            ('dot_update_errors', 'gauge', 'Errors.', [({}, 1)])])
+        write_metrics(filename, 'dot_update_', [
+            ('dot_update_errors', 'gauge', 'Errors.', [({}, 0)])])
+
+        with open(filename) as f:
+            eq_(['# HELP dot_status_env_dirty_files Dirty files.',
+                 '# TYPE dot_status_env_dirty_files gauge',
+                 'dot_status_env_dirty_files{env="zsh"} 2',
+                 'dot_status_env_dirty_files{env="say \\"hi\\""} 0',
+                 '# HELP dot_update_errors Errors.',
+                 '# TYPE dot_update_errors gauge',
+                 'dot_update_errors 0'],
+                f.read().splitlines())
+        eq_(['dot.prom'], os.listdir(tmp_dir))
+
+
+def test_files_are_counted_once_when_replaced_dir_is_planned_again():
+    from .history import read_history
+
+    with temp_tree(['base/zsh/.zsh/aliases', 'home/']) as tmp_dir:
+        base = os.path.join(tmp_dir, 'base')
+        home = os.path.join(tmp_dir, 'home')
+        args = {'--dry': False, '--skip-pull': True}
+        update(base, home, args)
+        eq_(True, os.path.islink(os.path.join(home, '.zsh')))
+
+        os.makedirs(os.path.join(base, 'git', '.zsh'))
+        open(os.path.join(base, 'git', '.zsh', 'git-prompt'), 'w').close()
+        update(base, home, dict(args, **{'--only': [os.path.join(home, '.zsh', 'git-prompt')]}))
+        eq_(False, os.path.islink(os.path.join(home, '.zsh')))
+        eq_(2, read_history(base)[-1]['counts']['files'])
+
+
+def test_dry_runs_are_not_recorded_in_history():
+    from .history import read_history
+
+    with temp_tree(['base/zsh/.zshrc', 'home/']) as tmp_dir:
+        base = os.path.join(tmp_dir, 'base')
+        home = os.path.join(tmp_dir, 'home')
+        update(base, home, {'--dry': True, '--skip-pull': True})
+        eq_([], read_history(base))
+        update(base, home, {'--dry': False, '--skip-pull': True})
+        eq_([False], [record['dry'] for record in read_history(base)])
+
+
+def test_only_files_of_several_envs_are_counted_as_conflicts():
+    with temp_tree(['base/zsh/.zshrc',
+                    'base/bash/.zshrc',
+                    'base/bash/.bashrc',
+                    'home/.bashrc']) as tmp_dir:
+        base = os.path.join(tmp_dir, 'base')
+        home = os.path.join(tmp_dir, 'home')
+        filename = os.path.join(tmp_dir, 'dot.prom')
+        update(base, home, {'--dry': False, '--skip-pull': True,
+                            '--metrics-file': filename})
+
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        # existing .bashrc is an error, but not a conflict
+        assert 'dot_update_conflicts 1' in lines, lines
+        assert 'dot_update_errors 2' in lines, lines
+
+
+def test_trace_has_spans_of_each_thread():
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+    from . import phases
+    from .trace import TraceRecorder
+
+    def pull(env):
+        with phases.phase('pull', env):
+            pass
+
+    with TraceRecorder() as tracer, phases.observe(tracer):
+        with phases.phase('pull'):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(pull, ['zsh', 'emacs']))
+        phases.count('files', 2)
+
+    trace = json.loads(json.dumps(tracer.get_trace()))
+    events = trace['traceEvents']
+    eq_(['emacs', 'pull', 'zsh'],
+        sorted(event['name'] for event in events if event['ph'] == 'B'))
+    eq_(3, sum(1 for event in events if event['ph'] == 'E'))
+    eq_([{'files': 2}], [event['args'] for event in events if event['ph'] == 'C'])
+
+    # threads are named, and each span ends on the thread it began
+    tids = set(event['tid'] for event in events if event['ph'] == 'M')
+    for tid in tids:
+        phs = [event['ph'] for event in events
+               if event['tid'] == tid and event['ph'] in 'BE']
+        eq_(phs.count('B'), phs.count('E'))
+
+
+def test_pull_updates_submodules_which_are_scanned_without_gitlinks():
+    import subprocess
+    from unittest import mock
+
+    def git(*args):
+        subprocess.check_call(('git',) + args, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    git_env = dict(GIT_AUTHOR_NAME='dot', GIT_AUTHOR_EMAIL='dot@example.com',
+                   GIT_COMMITTER_NAME='dot', GIT_COMMITTER_EMAIL='dot@example.com',
+                   # submodules are cloned from local paths
+                   GIT_CONFIG_COUNT='1',
+                   GIT_CONFIG_KEY_0='protocol.file.allow',
+                   GIT_CONFIG_VALUE_0='always')
+
+    with temp_tree(['origin/.zshrc', 'plugin/plugin.zsh']) as tmp_dir, \
+            mock.patch.dict(os.environ, git_env):
+        origin = os.path.join(tmp_dir, 'origin')
+        plugin = os.path.join(tmp_dir, 'plugin')
+        for path in (origin, plugin):
+            git('init', '-q', path)
+            git('-C', path, 'add', '.')
+            git('-C', path, 'commit', '-q', '-m', 'initial')
+        git('clone', '-q', origin, os.path.join(tmp_dir, 'base', 'zsh'))
+
+        git('-C', origin, 'submodule', 'add', '-q', plugin, '.zsh/plugin')
+        git('-C', origin, 'commit', '-q', '-m', 'plugin')
+
+        base = os.path.join(tmp_dir, 'base')
+        old_head, new_head = make_pull(base, 'zsh', submodules=True)
+        assert old_head != new_head
+        eq_([os.path.join(base, 'zsh', path)
+             for path in ('.gitmodules', '.zsh/plugin/plugin.zsh', '.zshrc')],
+            sorted(scan_envs(base, ['zsh'])))
+
+
+def test_pipelined_planning_lists_home_once():
+    from . import phases
+    from .real_filesystem import RealFS
+
+    class BatchObserver(object):
+        def __init__(self):
+            self.batches = []
+
+        def start(self, name, detail=None):
+            if name == 'fs-batch':
+                self.batches.append(detail)
+
+        def finish(self, name, detail=None):
+            pass
+
+        def count(self, name, value):
+            pass
+
+    with temp_tree(['base/zsh/.zshrc',
+                    'base/zsh/.zsh/aliases',
+                    'base/git/.gitconfig',
+                    'base/git/.zsh/git-prompt',
+                    'base/emacs/.emacs.d/init.el',
+                    'home/']) as tmp_dir:
+        base = os.path.join(tmp_dir, 'base')
+        home = os.path.join(tmp_dir, 'home')
+        with phases.observe(BatchObserver()) as observer:
+            actions = create_actions_pipelined(base, home, ['emacs', 'git', 'zsh'],
+                                               RealFS(), pull=False)
+        # home for all plans, then .zsh shared by two envs
+        eq_(['list 1 dirs', 'list 1 dirs'], observer.batches)
+        eq_(create_install_actions(base, home, create_tree_from_filesystem(
+            base, ['emacs', 'git', 'zsh']), RealFS()), actions)
@@ -0,0 +1,74 @@
+# coding: utf-8
+"""Timeline of a run in the Trace Event Format.
+
+Each phase and each span inside of it, like a pull of one env, becomes
+a pair of begin and end events on the thread where it ran. Numbers
+reported with `phases.count()` become counters, growing during the
+run. The file could be opened with chrome://tracing, Perfetto or
+speedscope to see what runs concurrently and where the run stalls.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import threading
+import time
+
+
+class TraceRecorder(object):
+    """Phases observer, which collects trace events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = None
+        self._threads = {}
+        self._pid = os.getpid()
+        self._totals = {}
+        self.events = []
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        event.update(pid=self._pid,
+                     tid=thread.ident,
+                     # microseconds since the start of the run
+                     ts=round((time.perf_counter() - self._started) * 1e6, 1))
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads[thread.ident] = thread.name
+            self.events.append(event)
+
+    def start(self, name, detail=None):
+        event = dict(ph='B', name=detail or name, cat=name)
+        if detail is not None:
+            event['args'] = dict(phase=name)
+        self._add(event)
+
+    def finish(self, name, detail=None):
+        self._add(dict(ph='E', name=detail or name, cat=name))
+
+    def count(self, name, value):
+        # counters are drawn as they grow during the run
+        with self._lock:
+            total = self._totals[name] = self._totals.get(name, 0) + value
+        self._add(dict(ph='C', name=name, args={name: total}))
+
+    def get_trace(self):
+        with self._lock:
+            names = [dict(ph='M', name='thread_name', pid=self._pid, tid=tid,
+                          args=dict(name=name))
+                     for tid, name in sorted(self._threads.items())]
+            return dict(traceEvents=names + self.events,
+                        displayTimeUnit='ms')
+
+    def write(self, filename):
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(self.get_trace(), f)
+        os.rename(temp_filename, filename)
@@ -1,4 +1,7 @@
 # coding: utf-8
+import errno
+import os.path
+
 
 class Node(dict):
     def __init__(self, full_path):
@@ -17,6 +20,11 @@ class VirtualFS(object):
     def __init__(self, real_fs):
         self._overlay = Node('')
         self._real_fs = real_fs
+        # resolved paths are remembered until the next
+        # destructive operation, which bumps the generation
+        self._generation = 0
+        self._realpaths = {}
+        self._realpaths_generation = 0
 
     def _split(self, path):
         """Returns path's parts except the first one which is empty string.
@@ -51,12 +59,14 @@ class VirtualFS(object):
         return subtree
         
     def rm(self, path):
+        self._generation += 1
         subtree = self._create_path(path)
         subtree.deleted = True
         # remove all children
         subtree.clear()
 
     def mkdir(self, path):
+        self._generation += 1
         parts = self._split(path)
         subtree = self._overlay
 
@@ -65,6 +75,7 @@ class VirtualFS(object):
             subtree = subtree[part]
 
     def link(self, source, target):
+        self._generation += 1
         source = self._create_path(source)
         target = self._create_path(target)
         target.symlink = source
@@ -101,16 +112,61 @@ class VirtualFS(object):
         return node.symlink.full_path
     
 
-    def realpath(self, path):
-        parts = self._split(path)
+    def _get_link(self, path):
+        """Returns absolute target of the symlink or None if
+        the path is not a symlink. Parent of the path should be
+        already resolved."""
         subtree = self._overlay
-        for idx, part in enumerate(parts):
-            if part not in subtree:
-                return self._real_fs.realpath(
-                    self._join(subtree.full_path, *parts[idx:]))
-
-            subtree = subtree[part]
+        removed = False
+        for part in self._split(path):
+            removed = removed or subtree.deleted
+            subtree = subtree.get(part)
+            if subtree is None:
+                break
+
+        if subtree is not None:
+            if subtree.deleted:
+                return None
             if subtree.symlink is not None:
-                subtree = subtree.symlink
-        
-        return subtree.full_path
+                return subtree.symlink.full_path
+        if removed:
+            # real file is inside of removed directory
+            return None
+
+        if self._real_fs.is_symlink(path):
+            return os.path.normpath(os.path.join(
+                os.path.dirname(path), self._real_fs.get_symlink_target(path)))
+        return None
+
+    def _realpath(self, path, seen):
+        parts = self._split(path)
+        if not parts:
+            return '/'
+
+        path = '/' + self._join(*parts)
+        result = self._realpaths.get(path)
+        if result is None:
+            parent = self._realpath(self._join('', *parts[:-1]), seen)
+            candidate = os.path.join(parent, parts[-1])
+            target = self._get_link(candidate)
+
+            if target is None:
+                result = candidate
+            else:
+                if candidate in seen:
+                    raise OSError(errno.ELOOP, 'Symlink loop', candidate)
+                seen.add(candidate)
+                result = self._realpath(target, seen)
+                seen.discard(candidate)
+
+            self._realpaths[path] = result
+        return result
+
+    def realpath(self, path):
+        """Resolves symlinks in the path, one component at a time,
+        remembering results for all its prefixes.
+        Raises OSError if there is a symlink loop."""
+        if self._realpaths_generation != self._generation:
+            self._realpaths = {}
+            self._realpaths_generation = self._generation
+        return self._realpath(path, set())